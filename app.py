@@ -1,27 +1,60 @@
 import os
-from flask import Flask, request, redirect, url_for, render_template, session, send_from_directory
+from flask import Flask, request, redirect, url_for, render_template, session, send_from_directory, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import fitz # PyMuPDF
 import anthropic
 from docx import Document
 from datetime import datetime
-import shutil # For copying placeholder image
+import shutil # For removing artifact directories
 import google.generativeai as genai # For Gemini API
 import openai # For OpenAI API
 import requests # For fetching image from URL if Gemini returns that
 from PIL import Image # For image processing if Gemini returns image bytes
 import io # For image processing if Gemini returns image bytes
-
-
-UPLOAD_FOLDER = 'uploads'
-DOCS_FOLDER = 'docs' # For saving summaries
+import threading # For the background job registry
+import uuid # For job ids
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED # Worker pools for jobs, pipeline stages and PDF extraction
+import hashlib # For content-addressed result cache keys
+import json # For serializing cached results
+import sqlite3 # For the persistent result cache
+import time # For cache LRU bookkeeping and provider rate limiting
+import random # For jittered retry backoff
+import zipfile # For batch uploads of zipped PDFs
+import click # For the batch command-line entry point (ships with Flask)
+import contextvars # For attributing token usage to the job that caused it
+import html # For the HTML summary export
+import re # For heading and boilerplate detection during text condensation
+import difflib # For comparing a summary with the one of a near-duplicate paper
+from array import array # For packing MinHash signatures
+import mimetypes # For serving images from the media store
+import multiprocessing # For a fork-safe start method for the extraction pool
+import tempfile # For handing large uploads to the extraction pool by path
+try:
+    import tiktoken # Optional: exact token counts for chunking
+except ImportError:
+    tiktoken = None
+from pdf_extraction import open_pdf, extract_page, extract_page_range # Imports only fitz, for the extraction workers
+
+
+DOCS_FOLDER = 'docs' # For cached summary exports
 # Define DOCS_DIR for send_from_directory
 DOCS_DIR = os.path.abspath(DOCS_FOLDER)
 
 STATIC_IMAGES_FOLDER = 'static/images' # For saving visualizations
 
+CACHE_FOLDER = 'cache' # For the persistent result cache
+ARTIFACTS_FOLDER = 'artifacts' # For server-side per-upload artifacts (extracted text, summaries)
+
+# Models used by the pipeline. They are part of the result cache key, so changing a
+# model (or bumping PIPELINE_VERSION after editing a prompt) invalidates cached results.
+OPENAI_SUMMARY_MODEL = "gpt-3.5-turbo" # Or another suitable model like gpt-4-turbo-preview
+ANTHROPIC_PROMPT_MODEL = "claude-3-sonnet-20240229" # Using Sonnet as a balance
+PIPELINE_VERSION = "3" # 2: text condensation before summarization; 3: images live in the media store
+
 ALLOWED_EXTENSIONS = {'pdf'}
 
+PAGE_SEPARATOR = "\f" # Inserted between pages of extracted text so long papers can be chunked on page boundaries
+
 app = Flask(__name__)
 
 # --- API Key Configuration ---
@@ -33,15 +66,119 @@ app = Flask(__name__)
 app.config['OPENAI_API_KEY'] = os.environ.get('OPENAI_API_KEY')
 app.config['ANTHROPIC_API_KEY'] = os.environ.get('ANTHROPIC_API_KEY')
 app.config['GEMINI_API_KEY'] = os.environ.get('GEMINI_API_KEY')
+# Optional endpoint overrides, e.g. for a proxy or a local stand-in server.
+app.config['OPENAI_BASE_URL'] = os.environ.get('OPENAI_BASE_URL')
+app.config['ANTHROPIC_BASE_URL'] = os.environ.get('ANTHROPIC_BASE_URL')
 # --- End API Key Configuration ---
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.secret_key = 'super secret key'  # Needed for session management
-
-# Create upload, docs, and static/images folders if they don't exist
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+# --- Provider Gateway Configuration ---
+# 'live' calls the real APIs; 'fake' uses in-process stand-ins (no keys or network needed).
+app.config['LLM_BACKEND'] = os.environ.get('LLM_BACKEND', 'live')
+app.config['FAKE_LLM_LATENCY_SECONDS'] = float(os.environ.get('FAKE_LLM_LATENCY_SECONDS', '0'))
+app.config['PROVIDER_TIMEOUT_SECONDS'] = float(os.environ.get('PROVIDER_TIMEOUT_SECONDS', '120'))
+app.config['PROVIDER_MAX_RETRIES'] = int(os.environ.get('PROVIDER_MAX_RETRIES', '5'))
+app.config['PROVIDER_BACKOFF_BASE_SECONDS'] = float(os.environ.get('PROVIDER_BACKOFF_BASE_SECONDS', '1'))
+app.config['PROVIDER_BACKOFF_MAX_SECONDS'] = float(os.environ.get('PROVIDER_BACKOFF_MAX_SECONDS', '30'))
+# Per-provider limits; match these to your account's tier. 0 means unlimited.
+app.config['OPENAI_REQUESTS_PER_MINUTE'] = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '500'))
+app.config['OPENAI_TOKENS_PER_MINUTE'] = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '200000'))
+app.config['ANTHROPIC_REQUESTS_PER_MINUTE'] = int(os.environ.get('ANTHROPIC_REQUESTS_PER_MINUTE', '50'))
+app.config['ANTHROPIC_TOKENS_PER_MINUTE'] = int(os.environ.get('ANTHROPIC_TOKENS_PER_MINUTE', '40000'))
+app.config['GEMINI_REQUESTS_PER_MINUTE'] = int(os.environ.get('GEMINI_REQUESTS_PER_MINUTE', '60'))
+app.config['GEMINI_TOKENS_PER_MINUTE'] = int(os.environ.get('GEMINI_TOKENS_PER_MINUTE', '1000000'))
+# --- End Provider Gateway Configuration ---
+
+# Number of background workers running the summarize/visualize pipeline.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', '4'))
+# Finished job records (with their results) kept for /results; the oldest beyond this are dropped.
+app.config['JOB_MAX_FINISHED'] = int(os.environ.get('JOB_MAX_FINISHED', '1000'))
+# Retention for cached summary exports in docs/.
+app.config['EXPORTS_MAX_FILES'] = int(os.environ.get('EXPORTS_MAX_FILES', '5000'))
+app.config['EXPORTS_MAX_BYTES'] = int(os.environ.get('EXPORTS_MAX_BYTES', str(1024 * 1024 * 1024)))
+app.config['EXPORTS_MAX_AGE_SECONDS'] = int(os.environ.get('EXPORTS_MAX_AGE_SECONDS', str(30 * 24 * 60 * 60)))
+app.config['EXPORTS_PRUNE_INTERVAL'] = int(os.environ.get('EXPORTS_PRUNE_INTERVAL', '300'))
+# Near-duplicate detection for revised versions of already processed papers.
+# NEAR_DUPLICATE_POLICY: 'offer' asks the user whether to reuse the earlier summary,
+# 'reuse' reuses it automatically, 'off' disables detection.
+app.config['NEAR_DUPLICATE_POLICY'] = os.environ.get('NEAR_DUPLICATE_POLICY', 'offer')
+app.config['NEAR_DUPLICATE_THRESHOLD'] = float(os.environ.get('NEAR_DUPLICATE_THRESHOLD', '0.85'))
+app.config['NEAR_DUPLICATE_INDEX_PATH'] = os.environ.get('NEAR_DUPLICATE_INDEX_PATH', os.path.join(CACHE_FOLDER, 'near_duplicates.sqlite3'))
+# Full-text search index over generated summaries (/search).
+app.config['SEARCH_INDEX_PATH'] = os.environ.get('SEARCH_INDEX_PATH', os.path.join(CACHE_FOLDER, 'search.sqlite3'))
+# Print one structured JSON log line per finished job.
+app.config['JSON_JOB_LOGS'] = os.environ.get('JSON_JOB_LOGS', '0') == '1'
+# Maximum number of PDFs accepted in one /batch request (zip members included).
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('BATCH_MAX_FILES', '500'))
+# Threads shared by all jobs for running independent pipeline stages concurrently
+# (at most two per job: the visualization chain and publishing the finished summary).
+app.config['STAGE_WORKERS'] = int(os.environ.get('STAGE_WORKERS', str(app.config['JOB_WORKERS'] * 2)))
+# PDF extraction limits and parallelism. Documents with at least
+# PARALLEL_EXTRACTION_MIN_PAGES pages are split by page range across EXTRACTION_WORKERS processes.
+app.config['MAX_PDF_BYTES'] = int(os.environ.get('MAX_PDF_BYTES', str(100 * 1024 * 1024)))
+app.config['MAX_PDF_PAGES'] = int(os.environ.get('MAX_PDF_PAGES', '1000'))
+app.config['EXTRACTION_WORKERS'] = int(os.environ.get('EXTRACTION_WORKERS', str(min(4, os.cpu_count() or 1))))
+app.config['PARALLEL_EXTRACTION_MIN_PAGES'] = int(os.environ.get('PARALLEL_EXTRACTION_MIN_PAGES', '64'))
+# Stream the summary to the results page over Server-Sent Events as it is generated. Each
+# open stream holds a request worker until the summary stage finishes (the page then polls
+# /jobs/<job_id> for the rest), so serve with threaded or async workers (e.g. gunicorn
+# --threads N or --worker-class gevent) when this is on, or set STREAM_SUMMARY=0.
+app.config['STREAM_SUMMARY'] = os.environ.get('STREAM_SUMMARY', '1') == '1'
+app.config['SSE_KEEPALIVE_SECONDS'] = float(os.environ.get('SSE_KEEPALIVE_SECONDS', '15'))
+# Drop running headers/footers, page numbers, acknowledgements, references and appendices
+# from the extracted text before it is sent to the LLM.
+app.config['CONDENSE_TEXT'] = os.environ.get('CONDENSE_TEXT', '1') == '1'
+# Long papers are summarized map-reduce style in chunks of at most SUMMARY_CHUNK_TOKENS,
+# with at most SUMMARY_MAX_CONCURRENCY chunk requests in flight per paper.
+app.config['SUMMARY_CHUNK_TOKENS'] = int(os.environ.get('SUMMARY_CHUNK_TOKENS', '6000'))
+app.config['SUMMARY_MAX_CONCURRENCY'] = int(os.environ.get('SUMMARY_MAX_CONCURRENCY', '4'))
+# Server-side per-upload artifact store: 'local' (files under ARTIFACT_STORE_PATH) or
+# 'sqlite' (ARTIFACT_STORE_PATH is the database file). Uploads untouched for longer than
+# ARTIFACT_TTL_SECONDS are removed.
+app.config['ARTIFACT_STORE'] = os.environ.get('ARTIFACT_STORE', 'local')
+app.config['ARTIFACT_STORE_PATH'] = os.environ.get('ARTIFACT_STORE_PATH', ARTIFACTS_FOLDER if app.config['ARTIFACT_STORE'] == 'local' else os.path.join(ARTIFACTS_FOLDER, 'artifacts.sqlite3'))
+app.config['ARTIFACT_TTL_SECONDS'] = int(os.environ.get('ARTIFACT_TTL_SECONDS', str(24 * 60 * 60)))
+app.config['ARTIFACT_CLEANUP_INTERVAL'] = int(os.environ.get('ARTIFACT_CLEANUP_INTERVAL', '600'))
+# Persistent result cache keyed by a hash of the PDF bytes; least recently used
+# entries are evicted once the stored payloads exceed RESULT_CACHE_MAX_BYTES.
+app.config['RESULT_CACHE_PATH'] = os.environ.get('RESULT_CACHE_PATH', os.path.join(CACHE_FOLDER, 'results.sqlite3'))
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+# Generated visualization images: 'local' (files under MEDIA_STORE_PATH) or 'sqlite'
+# (MEDIA_STORE_PATH is the database file).
+app.config['MEDIA_STORE'] = os.environ.get('MEDIA_STORE', 'local')
+app.config['MEDIA_STORE_PATH'] = os.environ.get('MEDIA_STORE_PATH', os.path.join(app.static_folder, 'images') if app.config['MEDIA_STORE'] == 'local' else os.path.join(ARTIFACTS_FOLDER, 'media.sqlite3'))
+# WebP renditions and thumbnails of generated images; images unused for
+# MEDIA_MAX_AGE_SECONDS are garbage-collected (checked every MEDIA_GC_INTERVAL seconds).
+app.config['MEDIA_WEBP_QUALITY'] = int(os.environ.get('MEDIA_WEBP_QUALITY', '80'))
+app.config['MEDIA_THUMBNAIL_SIZE'] = int(os.environ.get('MEDIA_THUMBNAIL_SIZE', '320'))
+app.config['MEDIA_MAX_AGE_SECONDS'] = int(os.environ.get('MEDIA_MAX_AGE_SECONDS', str(30 * 24 * 60 * 60)))
+app.config['MEDIA_GC_INTERVAL'] = int(os.environ.get('MEDIA_GC_INTERVAL', '3600'))
+# Job records: 'memory' (this process only), 'sqlite' (JOB_STORE_PATH is a database file shared by
+# the worker processes of one host) or 'file' (JOB_STORE_PATH is a directory shared by every host).
+app.config['JOB_STORE'] = os.environ.get('JOB_STORE', 'memory')
+app.config['JOB_STORE_PATH'] = os.environ.get('JOB_STORE_PATH', os.path.join(CACHE_FOLDER, 'jobs' if app.config['JOB_STORE'] == 'file' else 'jobs.sqlite3'))
+app.config['JOB_POLL_SECONDS'] = float(os.environ.get('JOB_POLL_SECONDS', '0.5'))
+# Streamed summary tokens are written to the sqlite/file job store in batches this often, not one by one.
+app.config['JOB_PARTIAL_FLUSH_SECONDS'] = float(os.environ.get('JOB_PARTIAL_FLUSH_SECONDS', '0.2'))
+# Running several worker processes on one host: set SECRET_KEY, JOB_STORE=sqlite and ARTIFACT_STORE=sqlite
+# (or keep 'local'), with every process using the same store and cache/index paths. The SQLite
+# backends rely on WAL and file locking, which are only safe on a local disk, so they do not span hosts.
+# Several hosts behind a load balancer: set the same SECRET_KEY everywhere, JOB_STORE=file and keep
+# ARTIFACT_STORE and MEDIA_STORE 'local', with JOB_STORE_PATH, ARTIFACT_STORE_PATH and MEDIA_STORE_PATH
+# on a mount shared by all hosts; these stores only write whole files with os.replace. The result
+# cache, search index and near-duplicate index are SQLite files and stay per host (RESULT_CACHE_PATH,
+# SEARCH_INDEX_PATH and NEAR_DUPLICATE_INDEX_PATH on local disk), so each host reuses, searches and
+# compares only the papers it processed itself.
+app.secret_key = os.environ.get('SECRET_KEY')  # Needed for session management
+if not app.secret_key:
+    if app.config['JOB_STORE'] != 'memory' or app.config['ARTIFACT_STORE'] != 'local':
+        # Several processes with the development key would share a publicly known session key.
+        raise RuntimeError("SECRET_KEY must be set when JOB_STORE or ARTIFACT_STORE is not the default.")
+    print("WARNING: SECRET_KEY is not set; using an insecure development key. Set SECRET_KEY in production.")
+    app.secret_key = 'super secret key'
+
+# Create docs and static/images folders if they don't exist
 os.makedirs(DOCS_FOLDER, exist_ok=True) # DOCS_DIR is derived from this
+os.makedirs(os.path.dirname(app.config['RESULT_CACHE_PATH']) or '.', exist_ok=True)
 # app.static_folder is 'static' by default. We want 'static/images'
 os.makedirs(os.path.join(app.static_folder, 'images'), exist_ok=True)
 
@@ -50,45 +187,399 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def parse_structured_summary(summary_text):
-    """Parses a string summary into a dictionary by section headers."""
-    parsed = {}
-    current_section = None
-    current_content = []
+class StructuredSummaryParser:
+    """
+    Incremental parser for "Section: content" summaries. Text can be fed in arbitrary
+    pieces (e.g. streamed tokens); a line is only interpreted once it is complete.
+    """
+    SECTION_HEADERS = ("Abstract:", "Introduction:", "Results:", "Discussion:")
 
-    if not isinstance(summary_text, str): # Handle cases where summary might not be a string
-        return {"Error": "Summary was not in expected string format."}
+    def __init__(self):
+        self.parsed = {}
+        self.current_section = None
+        self.current_content = []
+        self._pending_line = ""
+
+    def _finish_section(self):
+        if self.current_section and self.current_content:
+            self.parsed[self.current_section] = " ".join(self.current_content).strip()
 
-    for line in summary_text.strip().split('\n'):
+    def _process_line(self, line):
         line_stripped = line.strip()
-        if line_stripped.startswith("Abstract:") or \
-           line_stripped.startswith("Introduction:") or \
-           line_stripped.startswith("Results:") or \
-           line_stripped.startswith("Discussion:"):
-            if current_section and current_content:
-                parsed[current_section] = " ".join(current_content).strip()
+        if line_stripped.startswith(self.SECTION_HEADERS):
+            self._finish_section()
 
             parts = line_stripped.split(":", 1)
-            current_section = parts[0].strip()
-            current_content = [parts[1].strip()] if len(parts) > 1 else []
-        elif current_section:
-            current_content.append(line_stripped)
+            self.current_section = parts[0].strip()
+            self.current_content = [parts[1].strip()] if len(parts) > 1 else []
+        elif self.current_section:
+            self.current_content.append(line_stripped)
+
+    def feed(self, text):
+        """Consumes the next piece of text and processes every line it completes."""
+        lines = (self._pending_line + text).split('\n')
+        self._pending_line = lines.pop()
+        for line in lines:
+            self._process_line(line)
+
+    def snapshot(self):
+        """Sections parsed so far, including the partial content of the section being streamed."""
+        sections = dict(self.parsed)
+        if self.current_section:
+            content = self.current_content
+            pending = self._pending_line.strip()
+            if pending and not pending.startswith(self.SECTION_HEADERS):
+                content = content + [pending]
+            if content and " ".join(content).strip():
+                sections[self.current_section] = " ".join(content).strip()
+        return sections
+
+    def close(self):
+        """Processes any unfinished last line and returns the parsed sections."""
+        if self._pending_line:
+            self._process_line(self._pending_line)
+            self._pending_line = ""
+        self._finish_section() # Add the last section
+        return self.parsed
 
-    if current_section and current_content: # Add the last section
-        parsed[current_section] = " ".join(current_content).strip()
+def parse_structured_summary(summary_text):
+    """Parses a string summary into a dictionary by section headers."""
+    if not isinstance(summary_text, str): # Handle cases where summary might not be a string
+        return {"Error": "Summary was not in expected string format."}
+
+    parser = StructuredSummaryParser()
+    parser.feed(summary_text.strip())
+    parsed = parser.close()
 
     if not parsed: # If no sections were found, return the original text under a generic key
         return {"Full Summary": summary_text}
 
     return parsed
 
+# --- Metrics ---
+# In-process counters and histograms for the pipeline, rendered in the Prometheus text
+# format on /metrics. Each process keeps its own values; scrape every worker process.
+METRIC_HELP = {
+    'pipeline_stage_seconds': ('histogram', 'Wall-clock time per pipeline stage.'),
+    'pipeline_stage_errors_total': ('counter', 'Pipeline stages that failed or were skipped, by stage.'),
+    'pdf_extraction_seconds': ('histogram', 'Time spent extracting text from one PDF.'),
+    'pdf_extracted_bytes_total': ('counter', 'Bytes of PDF input extracted.'),
+    'pdf_extracted_pages_total': ('counter', 'PDF pages extracted.'),
+    'condensation_tokens_saved_total': ('counter', 'Estimated prompt tokens removed by text condensation.'),
+    'pdf_rejected_total': ('counter', 'PDFs rejected for exceeding a limit, by reason.'),
+    'provider_request_seconds': ('histogram', 'Latency of individual provider API calls.'),
+    'provider_errors_total': ('counter', 'Provider API errors by provider and exception type.'),
+    'provider_retries_total': ('counter', 'Provider API calls retried after a retryable error.'),
+    'provider_rate_limit_wait_seconds_total': ('counter', 'Time spent waiting on local provider rate limits.'),
+    'llm_tokens_total': ('counter', 'Tokens reported by provider APIs, by provider, model and kind (prompt/completion).'),
+    'jobs_total': ('counter', 'Finished background jobs by final status.'),
+    'job_seconds': ('histogram', 'Time from job start to finish.'),
+    'jobs_in_flight': ('gauge', 'Background jobs currently queued or running, by status.'),
+    'export_requests_total': ('counter', 'Summary export requests by format and cache (hit/miss).'),
+    'export_render_seconds': ('histogram', 'Time to render one summary export, by format.'),
+    'near_duplicate_query_seconds': ('histogram', 'Time to query the near-duplicate LSH index.'),
+    'near_duplicate_matches_total': ('counter', 'Uploads found to be near-duplicates of an earlier paper.'),
+    'search_query_seconds': ('histogram', 'Time to run one full-text summary search.'),
+    'media_images_total': ('counter', 'Generated images stored in the media store, by result (stored or deduplicated).'),
+    'result_cache_events_total': ('counter', 'Result cache lookups and maintenance, by event (hits/misses/stores/evictions).'),
+}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_metrics_lock = threading.Lock()
+_metric_counters = {} # (name, labels) -> value
+_metric_histograms = {} # (name, labels) -> [bucket counts..., sum, count]
+# Token usage of the job whose pipeline is running in the current context (see job_token_usage).
+_job_token_usage = contextvars.ContextVar('job_token_usage', default=None)
+
+def metrics_inc(name, amount=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def metrics_observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        histogram = _metric_histograms.get(key)
+        if histogram is None:
+            histogram = _metric_histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+def record_token_usage(provider, model, prompt_tokens, completion_tokens):
+    """Counts tokens reported by a provider and adds them to the current job's usage, if any."""
+    prompt_tokens, completion_tokens = prompt_tokens or 0, completion_tokens or 0
+    metrics_inc('llm_tokens_total', prompt_tokens, provider=provider, model=model, kind='prompt')
+    metrics_inc('llm_tokens_total', completion_tokens, provider=provider, model=model, kind='completion')
+    usage = _job_token_usage.get()
+    if usage is not None:
+        with _metrics_lock:
+            totals = usage.setdefault(provider, {'prompt_tokens': 0, 'completion_tokens': 0})
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+
+def submit_in_context(executor, fn, *args):
+    """executor.submit that carries the caller's context variables (e.g. job token usage) into the worker."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+def render_prometheus_metrics():
+    """Returns all metrics in the Prometheus text exposition format."""
+    job_counts = get_job_store().count_by_status()
+    in_flight = {status: job_counts.get(status, 0) for status in ('queued', 'running')}
+    with _result_cache_lock:
+        cache_events = dict(_result_cache_stats)
+    with _metrics_lock:
+        counters = dict(_metric_counters)
+        histograms = {key: list(values) for key, values in _metric_histograms.items()}
+
+    gauges = {('jobs_in_flight', (('status', status),)): count for status, count in in_flight.items()}
+    counters.update({('result_cache_events_total', (('event', event),)): count for event, count in cache_events.items()})
+
+    lines = []
+    for name, (metric_type, help_text) in METRIC_HELP.items():
+        source = histograms if metric_type == 'histogram' else counters if metric_type == 'counter' else gauges
+        series = sorted((labels, values) for (metric_name, labels), values in source.items() if metric_name == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, values in series:
+            if metric_type == 'histogram':
+                for bound, count in zip(METRIC_BUCKETS, values):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {values[-1]}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {values[-2]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(labels)} {values}")
+    return '\n'.join(lines) + '\n'
+
+def log_job_event(job):
+    """Writes one structured JSON log line for a finished job when JSON_JOB_LOGS is enabled."""
+    if not app.config['JSON_JOB_LOGS']:
+        return
+    result = job.get('result') or {}
+    print(json.dumps({
+        'event': 'job_finished',
+        'job_id': job['id'],
+        'upload_id': job.get('upload_id'),
+        'original_filename': job['original_filename'],
+        'status': job['status'],
+        'cached': job.get('cached', False),
+        'error': job.get('error'),
+        'started_at': job.get('started_at'),
+        'finished_at': job.get('finished_at'),
+        'seconds': job.get('seconds'),
+        'stage_timings': result.get('stage_timings'),
+        'stage_errors': result.get('stage_errors'),
+        'token_usage': result.get('token_usage'),
+    }), flush=True)
+# --- End Metrics ---
+
+# --- Provider Gateway ---
+# All OpenAI, Anthropic and Gemini calls go through this layer. Clients are created once
+# per process and reused, so their HTTP connection pools and TLS sessions survive across
+# requests. Each provider has token buckets for requests and tokens per minute; calls wait
+# for capacity instead of triggering 429s, and rate-limit, timeout, connection and 5xx
+# errors are retried with jittered exponential backoff. With LLM_BACKEND='fake' no network
+# calls are made at all, which is useful for local development and load tests.
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at rate_per_minute up to capacity; a rate of 0 means unlimited."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        if rate_per_minute < 0:
+            raise ValueError(f"Rate limit must be 0 (unlimited) or positive, got {rate_per_minute}")
+        self.unlimited = rate_per_minute == 0
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Blocks until amount tokens are available and takes them. Returns the seconds waited."""
+        if self.unlimited:
+            return 0.0
+        amount = min(float(amount), self.capacity) # A single oversized call must not wait forever
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate_per_second
+            time.sleep(delay)
+            waited += delay
+
+class _FakeResponse:
+    """Tiny attribute bag used to mimic SDK response objects."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+def _fake_latency():
+    latency = app.config['FAKE_LLM_LATENCY_SECONDS']
+    if latency > 0:
+        time.sleep(latency)
+
+class FakeOpenAIClient:
+    """Stands in for openai.OpenAI; only chat.completions.create is implemented."""
+
+    def __init__(self):
+        self.chat = _FakeResponse(completions=_FakeResponse(create=self._create))
+
+    def _create(self, model, messages, **kwargs):
+        _fake_latency()
+        prompt = messages[-1]['content']
+        closing_words = " ".join(prompt.split()[-40:])
+        content = ("Abstract: Fake summary produced by the local LLM backend.\n"
+                   f"Introduction: The paper text ends with: {closing_words}\n"
+                   "Results: No real model was called.\n"
+                   "Discussion: Set LLM_BACKEND=live to use the OpenAI API.")
+        if kwargs.get('stream'):
+            return self._stream(content, prompt)
+        usage = _FakeResponse(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(content))
+        return _FakeResponse(choices=[_FakeResponse(message=_FakeResponse(content=content))], usage=usage, model=model)
+
+    @staticmethod
+    def _stream(content, prompt):
+        for piece in content.split(' '):
+            yield _FakeResponse(choices=[_FakeResponse(delta=_FakeResponse(content=piece + ' '))], usage=None)
+        usage = _FakeResponse(prompt_tokens=estimate_tokens(prompt), completion_tokens=estimate_tokens(content))
+        yield _FakeResponse(choices=[], usage=usage)
+
+class FakeAnthropicClient:
+    """Stands in for anthropic.Anthropic; only messages.create is implemented."""
+
+    def __init__(self):
+        self.messages = _FakeResponse(create=self._create)
+
+    def _create(self, model, max_tokens, messages, **kwargs):
+        _fake_latency()
+        text = "A clean scientific illustration of the paper's key findings, with labeled diagrams and charts."
+        usage = _FakeResponse(input_tokens=estimate_tokens(messages[-1]['content']), output_tokens=estimate_tokens(text))
+        return _FakeResponse(content=[_FakeResponse(text=text)], usage=usage, model=model)
+
+_provider_clients = {}
+_provider_buckets = {}
+_provider_lock = threading.Lock()
+
+def use_fake_llm_backend():
+    return app.config['LLM_BACKEND'] == 'fake'
+
+def provider_available(provider):
+    """True if calls to provider ('openai', 'anthropic', 'gemini') can be made (API key set or fake backend)."""
+    return use_fake_llm_backend() or bool(app.config.get(f'{provider.upper()}_API_KEY'))
+
+def get_openai_client():
+    """Returns the shared OpenAI client (or the fake one when LLM_BACKEND='fake')."""
+    with _provider_lock:
+        if 'openai' not in _provider_clients:
+            if use_fake_llm_backend():
+                _provider_clients['openai'] = FakeOpenAIClient()
+            else:
+                _provider_clients['openai'] = openai.OpenAI(
+                    api_key=app.config.get('OPENAI_API_KEY'),
+                    base_url=app.config.get('OPENAI_BASE_URL') or None,
+                    timeout=app.config['PROVIDER_TIMEOUT_SECONDS'],
+                    max_retries=0) # Retries are handled by call_provider
+        return _provider_clients['openai']
+
+def get_anthropic_client():
+    """Returns the shared Anthropic client (or the fake one when LLM_BACKEND='fake')."""
+    with _provider_lock:
+        if 'anthropic' not in _provider_clients:
+            if use_fake_llm_backend():
+                _provider_clients['anthropic'] = FakeAnthropicClient()
+            else:
+                _provider_clients['anthropic'] = anthropic.Anthropic(
+                    api_key=app.config.get('ANTHROPIC_API_KEY'),
+                    base_url=app.config.get('ANTHROPIC_BASE_URL') or None,
+                    timeout=app.config['PROVIDER_TIMEOUT_SECONDS'],
+                    max_retries=0) # Retries are handled by call_provider
+        return _provider_clients['anthropic']
+
+def configure_gemini():
+    """Configures the google-generativeai module once per process."""
+    with _provider_lock:
+        if 'gemini' not in _provider_clients:
+            genai.configure(api_key=app.config.get('GEMINI_API_KEY'))
+            _provider_clients['gemini'] = genai
+        return _provider_clients['gemini']
+
+def _get_provider_buckets(provider):
+    with _provider_lock:
+        if provider not in _provider_buckets:
+            prefix = provider.upper()
+            _provider_buckets[provider] = (TokenBucket(app.config[f'{prefix}_REQUESTS_PER_MINUTE']),
+                                           TokenBucket(app.config[f'{prefix}_TOKENS_PER_MINUTE']))
+        return _provider_buckets[provider]
+
+_RETRYABLE_PROVIDER_ERRORS = (
+    openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError,
+    anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError,
+)
+
+def _retry_after_seconds(error):
+    """Reads a Retry-After header from a provider error, if there is one."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+def call_provider(provider, fn, estimated_tokens=0):
+    """
+    Calls fn() under provider's request/token limits, retrying retryable errors up to
+    PROVIDER_MAX_RETRIES times with full-jitter exponential backoff. The last error is
+    re-raised so callers keep their existing per-exception handling.
+    """
+    request_bucket, token_bucket = _get_provider_buckets(provider)
+    max_retries = app.config['PROVIDER_MAX_RETRIES']
+    for attempt in range(max_retries + 1):
+        waited = request_bucket.acquire(1)
+        if estimated_tokens:
+            waited += token_bucket.acquire(estimated_tokens)
+        if waited:
+            metrics_inc('provider_rate_limit_wait_seconds_total', waited, provider=provider)
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            # Observed before any backoff sleep, so the histogram measures the provider, not retries.
+            metrics_observe('provider_request_seconds', time.perf_counter() - started, provider=provider)
+            metrics_inc('provider_errors_total', provider=provider, exception=type(e).__name__)
+            if not isinstance(e, _RETRYABLE_PROVIDER_ERRORS) or attempt == max_retries:
+                raise
+            metrics_inc('provider_retries_total', provider=provider)
+            max_delay = app.config['PROVIDER_BACKOFF_MAX_SECONDS']
+            backoff = min(max_delay, app.config['PROVIDER_BACKOFF_BASE_SECONDS'] * (2 ** attempt))
+            # Honour Retry-After, but never park a worker for longer than the backoff cap.
+            delay = min(max_delay, max(random.uniform(0, backoff), _retry_after_seconds(e) or 0))
+            print(f"{provider} call failed ({type(e).__name__}); retry {attempt + 1}/{max_retries} in {delay:.2f}s")
+            time.sleep(delay)
+        else:
+            metrics_observe('provider_request_seconds', time.perf_counter() - started, provider=provider)
+            return result
+# --- End Provider Gateway ---
+
 def generate_visualization_prompt_with_anthropic(summary_text_or_dict):
     """
     Generates a visualization prompt using Anthropic API based on the summary.
     Accepts either a string summary or a dictionary of parsed summary sections.
     """
-    anthropic_api_key = app.config.get('ANTHROPIC_API_KEY')
-    if not anthropic_api_key:
+    if not provider_available('anthropic'):
         print("ANTHROPIC_API_KEY not found. Returning default visualization prompt.")
         return "Anthropic API key not set. Using default prompt: A generic scientific concept representing research findings."
 
@@ -109,7 +600,7 @@ def generate_visualization_prompt_with_anthropic(summary_text_or_dict):
         return "Empty summary. Default prompt: Abstract visualization of data."
 
     try:
-        client = anthropic.Anthropic(api_key=anthropic_api_key)
+        client = get_anthropic_client()
 
         claude_prompt_text = f"""
 Based on the following research paper summary, generate a concise and visually descriptive prompt (around 20-30 words) that can be used by an image generation AI to create a compelling visualization representing the core findings or essence of the paper.
@@ -121,13 +612,15 @@ Generated Image Prompt:
 """
         # The "Generated Image Prompt:" line helps instruct Claude to only return the prompt.
 
-        response = client.messages.create(
-            model="claude-3-sonnet-20240229", # Using Sonnet as a balance
+        response = call_provider('anthropic', lambda: client.messages.create(
+            model=ANTHROPIC_PROMPT_MODEL,
             max_tokens=100,
             messages=[
                 {"role": "user", "content": claude_prompt_text}
             ]
-        )
+        ), estimated_tokens=estimate_tokens(claude_prompt_text) + 100)
+        if getattr(response, 'usage', None):
+            record_token_usage('anthropic', ANTHROPIC_PROMPT_MODEL, response.usage.input_tokens, response.usage.output_tokens)
 
         if response.content and response.content[0].text:
             visualization_prompt = response.content[0].text.strip()
@@ -155,10 +648,11 @@ Generated Image Prompt:
         print(f"An unexpected error occurred with Anthropic: {e}")
         return f"Error: An unexpected error occurred with the Anthropic API - {e}"
 
-def generate_image_with_ai(prompt, base_filename_prefix="visualization"):
+def generate_image_with_ai(prompt):
     """
     Generates an image using an AI model (Gemini placeholder).
-    Attempts to use Gemini API if key is present, otherwise copies a placeholder image.
+    Attempts to use Gemini API if key is present, otherwise uses a placeholder image.
+    Returns the image's name in the media store (see store_image), or None.
     IMPORTANT NOTE: Direct text-to-image generation with the `google-generativeai`
     library is complex and model-dependent. As of early 2024, this library is more
     focused on text, chat, and multimodal understanding. True text-to-image generation
@@ -167,13 +661,6 @@ def generate_image_with_ai(prompt, base_filename_prefix="visualization"):
     for a Gemini API call but will likely default to placeholder logic due to these
     API specificities. A robust solution would require using the appropriate SDK and model name.
     """
-    gemini_api_key = app.config.get('GEMINI_API_KEY')
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    original_filename_no_ext = os.path.splitext(base_filename_prefix)[0]
-    image_filename = f"{original_filename_no_ext}_visualization_{timestamp}.png"
-    image_save_subpath = os.path.join('images', image_filename) # Relative path for web
-    image_abs_save_path = os.path.join(app.static_folder, image_save_subpath) # Absolute path for saving
 
     def _copy_placeholder_image():
         placeholder_src = os.path.join(app.static_folder, 'images', 'placeholder.png')
@@ -181,19 +668,20 @@ def generate_image_with_ai(prompt, base_filename_prefix="visualization"):
             print(f"Error: Placeholder image not found at {placeholder_src}")
             return None
         try:
-            shutil.copy(placeholder_src, image_abs_save_path)
-            print(f"Used placeholder image: {image_filename}")
-            return image_save_subpath # Return web accessible path
+            with open(placeholder_src, 'rb') as f:
+                image_name = store_image(f.read()) # Stored once, however often it is used
+            print(f"Used placeholder image: {image_name}")
+            return image_name # Served by the media route
         except Exception as e_copy:
             print(f"Error copying placeholder image: {e_copy}")
             return None
 
-    if not gemini_api_key:
+    if not app.config.get('GEMINI_API_KEY'):
         print("GEMINI_API_KEY not found or not set. Using placeholder image.")
         return _copy_placeholder_image()
 
     try:
-        genai.configure(api_key=gemini_api_key)
+        configure_gemini()
 
         # --- Placeholder for actual Gemini Text-to-Image API call ---
         # The `google-generativeai` library's direct text-to-image capabilities are specific
@@ -206,21 +694,17 @@ def generate_image_with_ai(prompt, base_filename_prefix="visualization"):
 
         # model = genai.GenerativeModel('gemini-1.0-pro-vision-latest') # This is an example, likely not for image gen from text
         # model = genai.GenerativeModel('text-to-image-model-name') # Replace with actual if available
-        # response = model.generate_content(prompt_text)
+        # response = call_provider('gemini', lambda: model.generate_content(prompt_text))
         #
         # If the response contained image bytes:
         # image_bytes = response.parts[0].inline_data.data # Highly speculative path to image bytes
-        # img = Image.open(io.BytesIO(image_bytes))
-        # img.save(image_abs_save_path, 'PNG')
-        # return image_save_subpath
+        # return store_image(image_bytes)
         #
         # If the response contained a URL to an image:
         # image_url = response.candidates[0].content.parts[0].file_data.uri # Highly speculative
         # img_response = requests.get(image_url)
         # img_response.raise_for_status()
-        # with open(image_abs_save_path, 'wb') as f:
-        #     f.write(img_response.content)
-        # return image_save_subpath
+        # return store_image(img_response.content)
 
         # Since direct, simple text-to-image is not a clear feature of `google-generativeai` for general models:
         raise NotImplementedError("Direct Gemini text-to-image generation via `google-generativeai` is not straightforwardly implemented here. Requires specific models (e.g., Imagen via Vertex AI SDK).")
@@ -237,62 +721,266 @@ def generate_image_with_ai(prompt, base_filename_prefix="visualization"):
         print("Falling back to placeholder image logic.")
         return _copy_placeholder_image()
 
-def save_summary_to_files(summary_text, base_filename_prefix="summary"):
-    """Saves the summary text to Markdown and DOCX files."""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    safe_prefix = os.path.splitext(base_filename_prefix)[0]
-    base_filename = f"{safe_prefix}_{timestamp}"
-
-    # Store both full path (for logging/internal use) and just filename (for downloads)
-    saved_file_details = {'md': None, 'docx': None}
-
-    # Save as Markdown
-    md_filename_only = f"{base_filename}.md"
-    md_filepath_full = os.path.join(DOCS_FOLDER, md_filename_only)
-    try:
-        with open(md_filepath_full, 'w', encoding='utf-8') as f:
-            f.write(summary_text)
-        saved_file_details['md'] = {'full_path': md_filepath_full, 'filename': md_filename_only}
-        print(f"Summary saved to {md_filepath_full}")
-    except Exception as e:
-        print(f"Error saving Markdown file: {e}")
-
-    # Save as DOCX
-    docx_filename_only = f"{base_filename}.docx"
-    docx_filepath_full = os.path.join(DOCS_FOLDER, docx_filename_only)
-    try:
-        doc = Document()
-        # Using the new parser for potentially structured summary
-        parsed_summary_for_docx = parse_structured_summary(summary_text)
-        if "Full Summary" in parsed_summary_for_docx and len(parsed_summary_for_docx.keys()) == 1:
-            # If it's just a single block of text
-            doc.add_paragraph(parsed_summary_for_docx["Full Summary"])
-        else: # Attempt to add with headings
-            for section, content in parsed_summary_for_docx.items():
-                if section != "Error": # Skip error messages
-                    doc.add_heading(section, level=1)
-                    doc.add_paragraph(content)
-
-        if not doc.paragraphs and not doc.sections: # If nothing was added (e.g. empty summary_text)
-             doc.add_paragraph(summary_text) # Fallback to raw text
-
-        doc.save(docx_filepath_full)
-        saved_file_details['docx'] = {'full_path': docx_filepath_full, 'filename': docx_filename_only}
-        print(f"Summary saved to {docx_filepath_full}")
-    except Exception as e:
-        print(f"Error saving DOCX file: {e}")
+# --- Document Exports ---
+# Summaries are exported on demand when a download is requested, not on every run. Each
+# rendering is cached in docs/ under a hash of the format and summary text, so a format is
+# rendered at most once per summary; the least recently used exports are pruned once
+# docs/ exceeds EXPORTS_MAX_FILES or EXPORTS_MAX_BYTES, or when older than EXPORTS_MAX_AGE_SECONDS.
+EXPORT_FORMATS = {} # format -> {'render': fn(summary_text) -> bytes, 'mimetype': ..., 'label': ...}
+EXPORT_VERSION = "1" # Bump when a renderer's output changes to invalidate cached exports
+_exports_lock = threading.Lock()
+_exports_last_prune = 0.0
+
+def export_renderer(fmt, mimetype, label):
+    """Registers fn(summary_text) -> bytes as the renderer for fmt (also the file extension)."""
+    def register(fn):
+        EXPORT_FORMATS[fmt] = {'render': fn, 'mimetype': mimetype, 'label': label}
+        return fn
+    return register
+
+@export_renderer('md', 'text/markdown', 'Markdown')
+def render_markdown_export(summary_text):
+    return summary_text.encode('utf-8')
+
+@export_renderer('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'DOCX')
+def render_docx_export(summary_text):
+    doc = Document()
+    # Using the new parser for potentially structured summary
+    parsed_summary_for_docx = parse_structured_summary(summary_text)
+    if "Full Summary" in parsed_summary_for_docx and len(parsed_summary_for_docx.keys()) == 1:
+        # If it's just a single block of text
+        doc.add_paragraph(parsed_summary_for_docx["Full Summary"])
+    else: # Attempt to add with headings
+        for section, content in parsed_summary_for_docx.items():
+            if section != "Error": # Skip error messages
+                doc.add_heading(section, level=1)
+                doc.add_paragraph(content)
+
+    if not doc.paragraphs and not doc.sections: # If nothing was added (e.g. empty summary_text)
+         doc.add_paragraph(summary_text) # Fallback to raw text
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+@export_renderer('html', 'text/html', 'HTML')
+def render_html_export(summary_text):
+    body = "".join(f"<h2>{html.escape(section)}</h2>\n<p>{html.escape(content)}</p>\n"
+                   for section, content in parse_structured_summary(summary_text).items())
+    return (f"<!DOCTYPE html>\n<html lang=\"en\">\n<head><meta charset=\"UTF-8\"><title>Paper Summary</title></head>\n"
+            f"<body>\n<h1>Paper Summary</h1>\n{body}</body>\n</html>\n").encode('utf-8')
+
+@export_renderer('json', 'application/json', 'JSON')
+def render_json_export(summary_text):
+    return json.dumps({'sections': parse_structured_summary(summary_text), 'summary_text': summary_text},
+                      indent=2).encode('utf-8')
+
+def get_export(summary_text, fmt):
+    """
+    Returns the path of the fmt export of summary_text in DOCS_FOLDER, rendering it only
+    if no cached copy exists. Raises KeyError for an unknown format.
+    """
+    renderer = EXPORT_FORMATS[fmt]
+    key = hashlib.sha256(f"{EXPORT_VERSION}|{fmt}|{summary_text}".encode('utf-8')).hexdigest()
+    path = os.path.join(DOCS_DIR, f"{key}.{fmt}")
+    if os.path.exists(path):
+        os.utime(path) # Marks it recently used for pruning
+        metrics_inc('export_requests_total', format=fmt, cache='hit')
+        return path
+
+    started = time.perf_counter()
+    data = renderer['render'](summary_text)
+    metrics_observe('export_render_seconds', time.perf_counter() - started, format=fmt)
+    metrics_inc('export_requests_total', format=fmt, cache='miss')
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    print(f"Summary exported to {path}")
+    maybe_prune_exports()
+    return path
+
+def prune_exports():
+    """Applies the retention policy to DOCS_FOLDER; returns the number of files removed."""
+    entries = []
+    for entry in os.scandir(DOCS_DIR):
+        if entry.is_file() and not entry.name.startswith('.'): # Keep .gitkeep
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort() # Least recently used first
+
+    cutoff = time.time() - app.config['EXPORTS_MAX_AGE_SECONDS']
+    total_bytes = sum(size for _, size, _ in entries)
+    remaining = len(entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if mtime >= cutoff and remaining <= app.config['EXPORTS_MAX_FILES'] and total_bytes <= app.config['EXPORTS_MAX_BYTES']:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        remaining -= 1
+        total_bytes -= size
+    return removed
+
+def maybe_prune_exports():
+    """Runs prune_exports at most once per EXPORTS_PRUNE_INTERVAL seconds."""
+    global _exports_last_prune
+    now = time.time()
+    with _exports_lock:
+        if now - _exports_last_prune < app.config['EXPORTS_PRUNE_INTERVAL']:
+            return
+        _exports_last_prune = now
+    removed = prune_exports()
+    if removed:
+        print(f"Exports: pruned {removed} file(s) from {DOCS_FOLDER}.")
+# --- End Document Exports ---
+
+
+def estimate_tokens(text):
+    """Approximate token count: exact with tiktoken if installed, otherwise ~4 characters per token."""
+    if tiktoken is not None:
+        try:
+            return len(tiktoken.encoding_for_model(OPENAI_SUMMARY_MODEL).encode(text, disallowed_special=()))
+        except Exception:
+            pass
+    return (len(text) + 3) // 4
+
+def _split_oversized_unit(unit, max_tokens):
+    """Splits one page that alone exceeds max_tokens on paragraph, then line, then character boundaries."""
+    for separator in ('\n\n', '\n'):
+        parts = [part for part in unit.split(separator) if part.strip()]
+        if len(parts) > 1:
+            pieces = []
+            for part in parts:
+                if estimate_tokens(part) > max_tokens:
+                    pieces.extend(_split_oversized_unit(part, max_tokens))
+                else:
+                    pieces.append(part)
+            return pieces
+    if tiktoken is None:
+        max_chars = max_tokens * 4
+        return [unit[i:i + max_chars] for i in range(0, len(unit), max_chars)]
+    # Dense numeric or non-Latin text can exceed 1 token per 4 characters, so with real token
+    # counts each piece is the longest prefix (found by bisection) that still fits.
+    pieces = []
+    start = 0
+    while start < len(unit):
+        low, high = start + 1, len(unit)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(unit[start:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        pieces.append(unit[start:low])
+        start = low
+    return pieces
+
+def chunk_text_for_summary(text, max_tokens):
+    """
+    Splits text into chunks of at most max_tokens (estimated), packing whole pages
+    (separated by PAGE_SEPARATOR) together and only cutting inside a page when that
+    page alone is too long.
+    """
+    units = []
+    for page in text.split(PAGE_SEPARATOR):
+        if not page.strip():
+            continue
+        if estimate_tokens(page) > max_tokens:
+            units.extend(_split_oversized_unit(page, max_tokens))
+        else:
+            units.append(page)
+
+    chunks = []
+    current, current_tokens = [], 0
+    for unit in units:
+        unit_tokens = estimate_tokens(unit)
+        if current and current_tokens + unit_tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(unit)
+        current_tokens += unit_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+SUMMARY_MAX_REDUCE_ROUNDS = 3 # Re-condensing rounds before the notes are truncated instead
+
+def _truncate_notes(notes, max_tokens):
+    """Cuts every note to an equal share of max_tokens, so all parts of the paper stay represented."""
+    share = max(1, max_tokens // len(notes))
+    return [note if estimate_tokens(note) <= share else _split_oversized_unit(note, share)[0] for note in notes]
+
+def _openai_chat(client, prompt_text, system_prompt, on_token=None):
+    """
+    Runs one chat completion and returns its text (None if empty). If on_token is given,
+    the completion is streamed and on_token is called with each piece of text as it arrives.
+    """
+    # The completion length is unknown up front; budget roughly a fifth of the prompt for it.
+    estimated_tokens = estimate_tokens(system_prompt) + estimate_tokens(prompt_text) * 6 // 5
+    response = call_provider('openai', lambda: client.chat.completions.create(
+        model=OPENAI_SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt_text}
+        ],
+        temperature=0.5, # Adjust for creativity vs. factuality
+        # max_tokens can be set if needed, but we want a full summary
+        **({'stream': True, 'stream_options': {'include_usage': True}} if on_token is not None else {}),
+    ), estimated_tokens=estimated_tokens)
+    if on_token is not None:
+        # Only opening the stream is retried; an error mid-stream fails the summary.
+        pieces = []
+        for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                pieces.append(delta)
+                on_token(delta)
+            if getattr(chunk, 'usage', None): # Sent in the final chunk because of include_usage
+                record_token_usage('openai', OPENAI_SUMMARY_MODEL, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+        return "".join(pieces).strip() or None
+    if getattr(response, 'usage', None):
+        record_token_usage('openai', OPENAI_SUMMARY_MODEL, response.usage.prompt_tokens, response.usage.completion_tokens)
+    if response.choices and response.choices[0].message and response.choices[0].message.content:
+        return response.choices[0].message.content.strip()
+    return None
+
+SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant skilled in summarizing research papers into structured formats."
+
+def _summarize_chunks_concurrently(client, chunks, part_label):
+    """Map step: condenses each chunk into notes, at most SUMMARY_MAX_CONCURRENCY requests at a time."""
+    def _summarize_chunk(index_and_chunk):
+        index, chunk = index_and_chunk
+        prompt_text = f"""
+The following is {part_label} {index + 1} of {len(chunks)} of a research paper.
+Write concise notes covering its purpose, methods, key results (keep concrete numbers) and conclusions.
+Do not add information that is not in the text.
 
-    return saved_file_details
+Text:
+{chunk}
+"""
+        notes = _openai_chat(client, prompt_text, SUMMARY_SYSTEM_PROMPT)
+        if notes is None:
+            raise ValueError(f"OpenAI API returned an empty response for {part_label} {index + 1}.")
+        return notes
 
+    max_workers = max(1, min(app.config['SUMMARY_MAX_CONCURRENCY'], len(chunks)))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summary-chunk') as executor:
+        futures = [submit_in_context(executor, _summarize_chunk, item) for item in enumerate(chunks)]
+        return [future.result() for future in futures] # Keeps document order
 
-def summarize_text_with_ai(text_to_summarize):
+def summarize_text_with_ai(text_to_summarize, on_token=None):
     """
     Summarizes the given text using an AI model.
-    Currently returns a mock summary.
     Uses OpenAI API key from app.config.
+    Text longer than SUMMARY_CHUNK_TOKENS is summarized map-reduce style: page-aligned
+    chunks are condensed concurrently, then the notes are merged into the structured format.
+    If on_token is given, the final (structured) completion is streamed through it.
     """
-    openai_api_key = app.config.get('OPENAI_API_KEY')
-    if not openai_api_key:
+    if not provider_available('openai'):
         print("OPENAI_API_KEY not found in environment variables or app.config. Returning mock summary.")
         return """Abstract: OpenAI API key not found. This is a mock abstract.
 Introduction: The system requires an OpenAI API key for real summarization with GPT.
@@ -301,29 +989,49 @@ Discussion: Please set the OPENAI_API_KEY environment variable for actual AI pro
 """
 
     try:
-        client = openai.OpenAI(api_key=openai_api_key)
+        client = get_openai_client()
+
+        max_chunk_tokens = app.config['SUMMARY_CHUNK_TOKENS']
+        chunks = chunk_text_for_summary(text_to_summarize, max_chunk_tokens)
+        if len(chunks) > 1:
+            print(f"Summarizing long text in {len(chunks)} chunks.")
+            notes = _summarize_chunks_concurrently(client, chunks, "part")
+            # Very long papers can produce more notes than fit in one request; condense again,
+            # for at most SUMMARY_MAX_REDUCE_ROUNDS rounds and only while the notes keep shrinking.
+            notes_tokens = estimate_tokens("\n\n".join(notes))
+            for _ in range(SUMMARY_MAX_REDUCE_ROUNDS):
+                if len(notes) <= 1 or notes_tokens <= max_chunk_tokens:
+                    break
+                condensed = _summarize_chunks_concurrently(client, chunk_text_for_summary(PAGE_SEPARATOR.join(notes), max_chunk_tokens), "set of notes")
+                condensed_tokens = estimate_tokens("\n\n".join(condensed))
+                if condensed_tokens >= notes_tokens:
+                    break
+                notes, notes_tokens = condensed, condensed_tokens
+            if notes_tokens > max_chunk_tokens:
+                print(f"Notes still ~{notes_tokens} tokens after condensing; truncating to ~{max_chunk_tokens}.")
+                notes = _truncate_notes(notes, max_chunk_tokens)
+            notes_text = "\n\n".join(notes)
+            prompt_text = f"""
+The following are notes on consecutive parts of one research paper.
+Combine them into a single summary structured into these distinct sections: Abstract, Introduction, Results, and Discussion.
+Ensure each section is clearly labeled (e.g., "Abstract: ...", "Introduction: ...").
 
-        prompt_text = f"""
+Notes:
+{notes_text}
+"""
+        else:
+            paper_text = text_to_summarize.replace(PAGE_SEPARATOR, "\n")
+            prompt_text = f"""
 Please summarize the following research paper text.
 Structure the summary into these distinct sections: Abstract, Introduction, Results, and Discussion.
 Ensure each section is clearly labeled (e.g., "Abstract: ...", "Introduction: ...").
 
 Research Paper Text:
-{text_to_summarize}
+{paper_text}
 """
 
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo", # Or another suitable model like gpt-4-turbo-preview
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant skilled in summarizing research papers into structured formats."},
-                {"role": "user", "content": prompt_text}
-            ],
-            temperature=0.5, # Adjust for creativity vs. factuality
-            # max_tokens can be set if needed, but we want a full summary
-        )
-
-        if response.choices and response.choices[0].message and response.choices[0].message.content:
-            structured_summary = response.choices[0].message.content.strip()
+        structured_summary = _openai_chat(client, prompt_text, SUMMARY_SYSTEM_PROMPT, on_token=on_token)
+        if structured_summary:
             # The summary should ideally already be in the "Section: Content" format.
             # The existing parse_structured_summary function in the /results route will handle it.
             return structured_summary
@@ -344,6 +1052,288 @@ Research Paper Text:
         print(f"An unexpected error occurred with OpenAI: {e}")
         return f"Error: An unexpected error occurred with the OpenAI API - {e}"
 
+# --- Text Condensation ---
+# Before the text goes to the LLM, running headers/footers, page numbers, acknowledgements,
+# the bibliography and appendices are removed. Headings are recognised from PyMuPDF's
+# font information (larger or bold short lines) or their shape (numbered or all-caps titles),
+# so this works on the page layout rather than on the plain text.
+HEADER_FOOTER_MARGIN = 0.08 # Top/bottom fraction of the page searched for running headers and footers
+TERMINAL_SECTION_RE = re.compile(r'^(?:[0-9IVX]+\.?\s*|[A-Z]\.?\s+)?(references|bibliography|works cited|literature cited|'
+                                 r'appendix|appendices|supplementary material|supplemental material)\b', re.IGNORECASE)
+SKIPPED_SECTION_RE = re.compile(r'^(?:[0-9IVX]+\.?\s*)?(acknowledge?ments?|funding|conflicts? of interest|'
+                                r'competing interests|author contributions)\b', re.IGNORECASE)
+NUMBERED_HEADING_RE = re.compile(r'^(?:\d+(?:\.\d+)*|[IVX]+|[A-Z])\.?\s+[A-Z][^.]{0,80}$')
+PAGE_NUMBER_RE = re.compile(r'^(?:page\s*)?\d+(?:\s*(?:of|/)\s*\d+)?$', re.IGNORECASE)
+
+def _normalize_repeated_line(text):
+    """Running headers differ only in page numbers, so digits are ignored when comparing."""
+    return re.sub(r'\d+', '#', text.lower()).strip()
+
+def condense_pages(page_layouts):
+    """
+    Condenses page layouts (from pdf_extraction.page_layout) into one text per page, dropping running
+    headers/footers, page numbers and skipped/terminal sections.
+    Returns (page_texts, stats).
+    """
+    stats = {'header_footer_lines': 0, 'page_number_lines': 0, 'headings': 0, 'removed_sections': []}
+
+    # Running headers/footers: margin lines repeated (modulo digits) on many pages.
+    margin_counts = {}
+    for page in page_layouts:
+        seen = set()
+        for text, _, _, top, bottom in page['lines']:
+            if bottom <= page['height'] * HEADER_FOOTER_MARGIN or top >= page['height'] * (1 - HEADER_FOOTER_MARGIN):
+                seen.add(_normalize_repeated_line(text))
+        for key in seen:
+            margin_counts[key] = margin_counts.get(key, 0) + 1
+    repeat_threshold = max(2, len(page_layouts) // 2)
+    repeated = {key for key, count in margin_counts.items() if count >= repeat_threshold}
+
+    # Body font size: the size covering the most characters outside the page margins.
+    size_chars = {}
+    for page in page_layouts:
+        for text, size, _, top, bottom in page['lines']:
+            if bottom > page['height'] * HEADER_FOOTER_MARGIN and top < page['height'] * (1 - HEADER_FOOTER_MARGIN):
+                size_chars[size] = size_chars.get(size, 0) + len(text)
+    body_size = max(size_chars, key=size_chars.get) if size_chars else 0
+
+    total_lines = sum(len(page['lines']) for page in page_layouts)
+    line_index = 0
+    skipping = None # Name of the section being dropped, if any
+    terminal = False # Everything after a references/appendix heading is dropped
+    page_texts = []
+    for page in page_layouts:
+        kept = []
+        for text, size, bold, top, bottom in page['lines']:
+            line_index += 1
+            in_margin = bottom <= page['height'] * HEADER_FOOTER_MARGIN or top >= page['height'] * (1 - HEADER_FOOTER_MARGIN)
+            if in_margin and _normalize_repeated_line(text) in repeated:
+                stats['header_footer_lines'] += 1
+                continue
+            if PAGE_NUMBER_RE.match(text) and (in_margin or len(page['lines']) == 1):
+                stats['page_number_lines'] += 1
+                continue
+            if terminal:
+                continue
+
+            is_heading = len(text.split()) <= 12 and (
+                size >= body_size * 1.15 or (bold and size >= body_size) or NUMBERED_HEADING_RE.match(text) is not None
+                or (text.isupper() and len(text.split()) <= 6))
+            if is_heading:
+                stats['headings'] += 1
+                # Only treat "References"/"Appendix" as terminal past the first 40% of the
+                # document, so a table of contents or an early mention does not cut everything.
+                if TERMINAL_SECTION_RE.match(text) and line_index > total_lines * 0.4:
+                    terminal = True
+                    stats['removed_sections'].append(text)
+                    continue
+                skipping = text if SKIPPED_SECTION_RE.match(text) else None
+                if skipping:
+                    stats['removed_sections'].append(text)
+                    continue
+            if skipping:
+                continue
+            kept.append(text)
+        if kept:
+            page_texts.append("\n".join(kept))
+    return page_texts, stats
+# --- End Text Condensation ---
+
+# --- PDF Extraction ---
+class PDFLimitError(ValueError):
+    """Raised when a PDF exceeds MAX_PDF_BYTES or MAX_PDF_PAGES."""
+
+class EmptyPDFError(ValueError):
+    """Raised when a PDF has no text to summarize (no text layer, or condensation removed it all)."""
+
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def _get_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            # The app is multi-threaded by the time the pool starts, and a forked child could
+            # inherit a lock held by another thread; start workers from a clean process instead.
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _extraction_pool = ProcessPoolExecutor(max_workers=app.config['EXTRACTION_WORKERS'],
+                                                   mp_context=multiprocessing.get_context(start_method))
+        return _extraction_pool
+
+def extract_pdf_text(source, stats=None):
+    """
+    Extracts the text of a PDF given as bytes (e.g. straight from the upload stream) or as
+    a file path, with pages joined by PAGE_SEPARATOR. Large documents are split into page
+    ranges that are extracted in parallel worker processes. With CONDENSE_TEXT the text is
+    condensed (see condense_pages) and pass stats={} to receive what was removed.
+    Raises PDFLimitError if the document exceeds MAX_PDF_BYTES or MAX_PDF_PAGES.
+    """
+    size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+    if size > app.config['MAX_PDF_BYTES']:
+        metrics_inc('pdf_rejected_total', reason='bytes')
+        raise PDFLimitError(f"PDF is {size} bytes; the limit is {app.config['MAX_PDF_BYTES']} bytes.")
+
+    started = time.perf_counter()
+    condense = app.config['CONDENSE_TEXT']
+    pages = _extract_pages(source, layout=condense)
+    metrics_observe('pdf_extraction_seconds', time.perf_counter() - started)
+    metrics_inc('pdf_extracted_bytes_total', size)
+    metrics_inc('pdf_extracted_pages_total', len(pages))
+    if not condense:
+        return PAGE_SEPARATOR.join(pages)
+
+    raw_tokens = estimate_tokens("\n".join(line[0] for page in pages for line in page['lines']))
+    page_texts, condense_stats = condense_pages(pages)
+    text = PAGE_SEPARATOR.join(page_texts)
+    condensed_tokens = estimate_tokens(text)
+    condense_stats.update(raw_tokens=raw_tokens, condensed_tokens=condensed_tokens,
+                          tokens_saved=raw_tokens - condensed_tokens)
+    metrics_inc('condensation_tokens_saved_total', max(0, raw_tokens - condensed_tokens))
+    print(f"Condensed text from ~{raw_tokens} to ~{condensed_tokens} tokens "
+          f"(removed sections: {', '.join(condense_stats['removed_sections']) or 'none'}).")
+    if stats is not None:
+        stats.update(condense_stats)
+    return text
+
+def _extract_pages(source, layout=False):
+    """
+    Returns the text (or layout, see pdf_extraction.page_layout) of every page, in order, using the
+    process pool for large documents.
+    """
+    doc = open_pdf(source)
+    try:
+        page_count = len(doc)
+        if page_count > app.config['MAX_PDF_PAGES']:
+            metrics_inc('pdf_rejected_total', reason='pages')
+            raise PDFLimitError(f"PDF has {page_count} pages; the limit is {app.config['MAX_PDF_PAGES']} pages.")
+
+        workers = app.config['EXTRACTION_WORKERS']
+        if workers <= 1 or page_count < app.config['PARALLEL_EXTRACTION_MIN_PAGES']:
+            return [extract_page(doc.load_page(page_num), layout) for page_num in range(page_count)]
+    finally:
+        doc.close()
+
+    range_size = -(-page_count // workers) # Ceiling division: one contiguous range per worker
+    ranges = [(start, min(start + range_size, page_count)) for start in range(0, page_count, range_size)]
+    temp_path = None
+    if isinstance(source, (bytes, bytearray)):
+        # Workers get a path rather than a pickled copy of the whole PDF per range.
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+            f.write(source)
+        source = temp_path = f.name
+    try:
+        pool = _get_extraction_pool()
+        futures = [pool.submit(extract_page_range, source, start, stop, layout) for start, stop in ranges]
+        pages = []
+        for future in futures: # Futures are kept in page order
+            pages.extend(future.result())
+        return pages
+    finally:
+        if temp_path:
+            os.remove(temp_path)
+# --- End PDF Extraction ---
+
+def ingest_upload(upload_id, filename, pdf_bytes=None):
+    """
+    Hashes and extracts one upload (pdf_bytes, or the upload's stored original.pdf) and
+    writes extracted_text.txt, condensation.json and upload.json to the artifact store.
+    Returns {'cache_key', 'extracted_text', 'near_duplicate', 'reused_result', 'near_duplicate_of'}.
+    reused_result is set, and extraction skipped, on a result cache hit; it is also set
+    when a near-duplicate is reused under the 'reuse' policy.
+    Raises PDFLimitError if the PDF is over the configured limits and EmptyPDFError if it
+    has no text.
+    """
+    artifact_store = get_artifact_store()
+    pdf_source = pdf_bytes
+    if pdf_bytes is None:
+        pdf_bytes = artifact_store.get(upload_id, 'original.pdf')
+        if pdf_bytes is None:
+            raise FileNotFoundError(f"The PDF for upload {upload_id} is missing from the artifact store.")
+        # Extraction workers can open a local file directly instead of receiving a copy.
+        pdf_source = artifact_store.local_path(upload_id, 'original.pdf') or pdf_bytes
+    ingest = {'cache_key': result_cache_key(pdf_bytes), 'extracted_text': None, 'near_duplicate': None,
+              'reused_result': None, 'near_duplicate_of': None}
+    cache_key = ingest['cache_key']
+
+    # A repeat upload of the same PDF skips extraction and all provider calls.
+    cached = result_cache_get(cache_key)
+    if cached:
+        print(f"Result cache hit for {filename}")
+        artifact_store.put(upload_id, 'upload.json', json.dumps({'original_filename': filename, 'cache_key': cache_key}))
+        index_summary(cache_key, filename, cached['result'], upload_id=upload_id) # Points the entry at the newest upload
+        ingest['reused_result'] = cached['result']
+        return ingest
+
+    condensation_stats = {}
+    extracted_text = extract_pdf_text(pdf_source, stats=condensation_stats)
+    if not extracted_text.strip(): # Nothing to pay the providers for
+        raise EmptyPDFError(f"No text could be extracted from {filename}.")
+    artifact_store.put(upload_id, 'extracted_text.txt', extracted_text)
+    if condensation_stats:
+        artifact_store.put(upload_id, 'condensation.json', json.dumps(condensation_stats))
+    ingest['extracted_text'] = extracted_text
+
+    near_duplicate = find_near_duplicate(extracted_text)
+    artifact_store.put(upload_id, 'upload.json', json.dumps({'original_filename': filename, 'cache_key': cache_key,
+                                                             'near_duplicate': near_duplicate}))
+    ingest['near_duplicate'] = near_duplicate
+    if near_duplicate and app.config['NEAR_DUPLICATE_POLICY'] == 'reuse':
+        reused_result = near_duplicate_result(near_duplicate['id'])
+        if reused_result is not None:
+            print(f"{filename} is a near-duplicate of {near_duplicate['original_filename']} "
+                  f"(similarity {near_duplicate['similarity']}); reusing its summary.")
+            index_summary(cache_key, filename, reused_result, upload_id=upload_id)
+            ingest['reused_result'] = reused_result
+            ingest['near_duplicate_of'] = near_duplicate['id']
+    return ingest
+
+def prepare_upload(pdf_bytes, filename):
+    """
+    Ingests one uploaded PDF (see ingest_upload) and returns
+    {'upload_id', 'cache_key', 'job_id', 'near_duplicate'}. job_id is only set when the
+    result was served from the result cache (or reused from a near-duplicate under the
+    'reuse' policy); otherwise the caller submits the job. near_duplicate describes a
+    similar earlier paper, if one was found.
+    Raises PDFLimitError if the PDF is over the configured limits and EmptyPDFError if it
+    has no text.
+    """
+    if len(pdf_bytes) > app.config['MAX_PDF_BYTES']:
+        raise PDFLimitError(f"PDF is larger than MAX_PDF_BYTES ({app.config['MAX_PDF_BYTES']} bytes).")
+    maybe_cleanup_artifacts()
+    maybe_gc_media()
+    upload_id = uuid.uuid4().hex
+    ingest = ingest_upload(upload_id, filename, pdf_bytes) # From memory; the PDF is not stored
+    job_id = None
+    if ingest['reused_result'] is not None:
+        job_id = complete_job_from_cache(upload_id, ingest['reused_result'], filename,
+                                         near_duplicate_of=ingest['near_duplicate_of'])
+    return {'upload_id': upload_id, 'cache_key': ingest['cache_key'], 'job_id': job_id,
+            'near_duplicate': ingest['near_duplicate']}
+
+def queue_upload(pdf_bytes, filename):
+    """
+    Stores one PDF as its upload's original.pdf and queues a job that does the hashing and
+    extraction too, so a request can accept many PDFs quickly. Returns (upload_id, job_id).
+    """
+    if len(pdf_bytes) > app.config['MAX_PDF_BYTES']:
+        raise PDFLimitError(f"PDF is larger than MAX_PDF_BYTES ({app.config['MAX_PDF_BYTES']} bytes).")
+    maybe_cleanup_artifacts()
+    maybe_gc_media()
+    upload_id = uuid.uuid4().hex
+    artifact_store = get_artifact_store()
+    artifact_store.put(upload_id, 'original.pdf', pdf_bytes)
+    artifact_store.put(upload_id, 'upload.json', json.dumps({'original_filename': filename}))
+    return upload_id, submit_job(upload_id, filename)
+
+def reuse_near_duplicate(upload_id, entry_id, filename, cache_key=None):
+    """Completes the upload with the indexed result of an earlier, similar paper. Returns the job id (None if gone)."""
+    reused_result = near_duplicate_result(entry_id)
+    if reused_result is None:
+        return None
+    job_id = complete_job_from_cache(upload_id, reused_result, filename, near_duplicate_of=entry_id)
+    index_summary(cache_key or upload_id, filename, reused_result, upload_id=upload_id)
+    return job_id
+
 @app.route('/', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
@@ -354,79 +1344,1957 @@ def upload_file():
             return redirect(request.url)
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
-            session['original_filename'] = filename
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            pdf_bytes = file.read(app.config['MAX_PDF_BYTES'] + 1) # Never buffer more than the limit
             try:
-                doc = fitz.open(filepath)
-                extracted_text = ""
-                for page_num in range(len(doc)):
-                    page = doc.load_page(page_num)
-                    extracted_text += page.get_text("text")
-                doc.close()
-                session['extracted_text'] = extracted_text
-                return redirect(url_for('process_and_summarize')) # Changed from display_summary to results
+                upload = prepare_upload(pdf_bytes, filename)
+            except (PDFLimitError, EmptyPDFError) as e:
+                print(f"Rejected {filename}: {e}")
+                return redirect(request.url)
             except Exception as e:
                 print(f"Error extracting text: {e}")
                 return redirect(request.url)
+
+            # Everything about this upload is kept server-side; the session only holds its id.
+            session['upload_id'] = upload['upload_id']
+            if upload['job_id']: # Served from the result cache
+                session['job_id'] = upload['job_id']
+                return redirect(url_for('results'))
+            if upload['near_duplicate'] and app.config['NEAR_DUPLICATE_POLICY'] == 'offer':
+                return redirect(url_for('near_duplicate', upload_id=upload['upload_id']))
+            return redirect(url_for('process_and_summarize')) # Changed from display_summary to results
         else:
             return redirect(request.url)
     return render_template('index.html')
 
-@app.route('/process_and_summarize')
-def process_and_summarize():
-    extracted_text = session.pop('extracted_text', None)
-    if not extracted_text:
-        return redirect(url_for('upload_file'))
+# --- Artifact Store ---
+# Per-upload artifacts (extracted text, summary, upload metadata) live on the server and
+# the cookie session only carries the upload id, so request and response sizes stay
+# constant no matter how large the paper is. Two backends are available: plain files
+# under ARTIFACT_STORE_PATH ('local') or rows in a SQLite database ('sqlite').
+ARTIFACT_CHUNK_SIZE = 64 * 1024 # Bytes per chunk for streaming reads
+
+def _validate_artifact_ref(upload_id, name):
+    if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+        raise ValueError(f"Invalid upload id: {upload_id!r}")
+    if not name or secure_filename(name) != name:
+        raise ValueError(f"Invalid artifact name: {name!r}")
+
+class LocalArtifactStore:
+    """Stores each artifact as <root>/<upload_id>/<name>."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, upload_id, name):
+        _validate_artifact_ref(upload_id, name)
+        return os.path.join(self.root, upload_id, name)
+
+    def put(self, upload_id, name, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        path = self._path(upload_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path) # Readers never see a partially written artifact
+
+    def get(self, upload_id, name):
+        try:
+            with open(self._path(upload_id, name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
 
-    structured_summary_text = summarize_text_with_ai(extracted_text)
-    session['structured_summary_text'] = structured_summary_text # Store raw text for parsing later
+    def iter_chunks(self, upload_id, name, chunk_size=ARTIFACT_CHUNK_SIZE):
+        """Yields the artifact in chunks without loading it whole; yields nothing if it is missing."""
+        try:
+            f = open(self._path(upload_id, name), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def exists(self, upload_id, name):
+        return os.path.exists(self._path(upload_id, name))
+
+    def local_path(self, upload_id, name):
+        """Path of an existing artifact on this host, or None (lets PDFs be opened without a copy)."""
+        path = self._path(upload_id, name)
+        return path if os.path.exists(path) else None
+
+    def delete(self, upload_id, name=None):
+        """Deletes one artifact, or the whole upload if name is None."""
+        if name is not None:
+            try:
+                os.remove(self._path(upload_id, name))
+            except FileNotFoundError:
+                pass
+            return
+        _validate_artifact_ref(upload_id, 'artifact')
+        shutil.rmtree(os.path.join(self.root, upload_id), ignore_errors=True)
+
+    def cleanup(self, ttl_seconds):
+        """Deletes uploads whose artifacts were last written more than ttl_seconds ago."""
+        cutoff = time.time() - ttl_seconds
+        removed = 0
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
+
+class SQLiteArtifactStore:
+    """Stores artifacts as blobs in a single SQLite database file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+                                upload_id TEXT NOT NULL,
+                                name TEXT NOT NULL,
+                                data BLOB NOT NULL,
+                                created_at REAL NOT NULL,
+                                PRIMARY KEY (upload_id, name))""")
+            conn.execute("CREATE INDEX IF NOT EXISTS artifacts_created_at ON artifacts (created_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def put(self, upload_id, name, data):
+        _validate_artifact_ref(upload_id, name)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO artifacts (upload_id, name, data, created_at) VALUES (?, ?, ?, ?)",
+                         (upload_id, name, data, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, upload_id, name):
+        _validate_artifact_ref(upload_id, name)
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM artifacts WHERE upload_id = ? AND name = ?", (upload_id, name)).fetchone()
+            return bytes(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def iter_chunks(self, upload_id, name, chunk_size=ARTIFACT_CHUNK_SIZE):
+        """Yields the artifact in chunks using SQLite incremental blob I/O; yields nothing if it is missing."""
+        _validate_artifact_ref(upload_id, name)
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT rowid FROM artifacts WHERE upload_id = ? AND name = ?", (upload_id, name)).fetchone()
+            if row is None:
+                return
+            with conn.blobopen('artifacts', 'data', row[0], readonly=True) as blob:
+                while True:
+                    chunk = blob.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            conn.close()
+
+    def exists(self, upload_id, name):
+        _validate_artifact_ref(upload_id, name)
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM artifacts WHERE upload_id = ? AND name = ?", (upload_id, name)).fetchone() is not None
+        finally:
+            conn.close()
 
-    original_pdf_filename = session.get('original_filename', 'uploaded_pdf')
-    summary_file_prefix = os.path.splitext(original_pdf_filename)[0]
+    def local_path(self, upload_id, name):
+        return None
 
-    # save_summary_to_files now returns a dict with 'full_path' and 'filename' for each type
-    saved_file_details = save_summary_to_files(structured_summary_text, base_filename_prefix=summary_file_prefix)
-    session['saved_summary_details'] = saved_file_details # e.g. {'md': {'full_path': '...', 'filename': '...'}, ...}
+    def delete(self, upload_id, name=None):
+        conn = self._connect()
+        try:
+            if name is not None:
+                _validate_artifact_ref(upload_id, name)
+                conn.execute("DELETE FROM artifacts WHERE upload_id = ? AND name = ?", (upload_id, name))
+            else:
+                conn.execute("DELETE FROM artifacts WHERE upload_id = ?", (upload_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def cleanup(self, ttl_seconds):
+        """Deletes uploads whose newest artifact is older than ttl_seconds."""
+        cutoff = time.time() - ttl_seconds
+        conn = self._connect()
+        try:
+            expired = [row[0] for row in conn.execute(
+                "SELECT upload_id FROM artifacts GROUP BY upload_id HAVING MAX(created_at) < ?", (cutoff,))]
+            conn.executemany("DELETE FROM artifacts WHERE upload_id = ?", [(upload_id,) for upload_id in expired])
+            conn.commit()
+            return len(expired)
+        finally:
+            conn.close()
+
+ARTIFACT_STORE_BACKENDS = {
+    'local': LocalArtifactStore,
+    'sqlite': SQLiteArtifactStore,
+}
+
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
+_artifact_last_cleanup = 0.0
+
+def get_artifact_store():
+    """Returns the process-wide artifact store configured by ARTIFACT_STORE/ARTIFACT_STORE_PATH."""
+    global _artifact_store
+    with _artifact_store_lock:
+        if _artifact_store is None:
+            backend = app.config['ARTIFACT_STORE']
+            if backend not in ARTIFACT_STORE_BACKENDS:
+                raise ValueError(f"Unknown ARTIFACT_STORE backend: {backend!r} (expected one of {sorted(ARTIFACT_STORE_BACKENDS)})")
+            _artifact_store = ARTIFACT_STORE_BACKENDS[backend](app.config['ARTIFACT_STORE_PATH'])
+        return _artifact_store
+
+def get_artifact_text(upload_id, name):
+    data = get_artifact_store().get(upload_id, name)
+    return data.decode('utf-8') if data is not None else None
+
+def get_artifact_json(upload_id, name):
+    data = get_artifact_store().get(upload_id, name)
+    return json.loads(data) if data is not None else None
+
+def maybe_cleanup_artifacts():
+    """Runs TTL cleanup at most once per ARTIFACT_CLEANUP_INTERVAL seconds; called on new uploads."""
+    global _artifact_last_cleanup
+    now = time.time()
+    with _artifact_store_lock:
+        if now - _artifact_last_cleanup < app.config['ARTIFACT_CLEANUP_INTERVAL']:
+            return
+        _artifact_last_cleanup = now
+    try:
+        removed = get_artifact_store().cleanup(app.config['ARTIFACT_TTL_SECONDS'])
+        if removed:
+            print(f"Artifact store: removed {removed} expired upload(s).")
+        removed_jobs = get_job_store().cleanup(app.config['ARTIFACT_TTL_SECONDS']) # Their uploads are gone too
+        if removed_jobs:
+            print(f"Job store: removed {removed_jobs} finished job(s).")
+    except Exception as e:
+        print(f"Artifact store cleanup failed: {e}")
+# --- End Artifact Store ---
+
+# --- Media Store ---
+# Generated visualization images. Like the artifact store, the backend is either a
+# directory ('local', which may be a mount shared by several hosts) or a SQLite file (one
+# host), so any worker process can serve an image another one generated.
+def _validate_media_name(name):
+    if not name or secure_filename(name) != name:
+        raise ValueError(f"Invalid media name: {name!r}")
+
+class LocalMediaStore:
+    """Stores each file as <root>/<name>."""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        _validate_media_name(name)
+        return os.path.join(self.root, name)
+
+    def put(self, name, data):
+        path = self._path(name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, name):
+        try:
+            with open(self._path(name), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
 
-    # Generate and store visualization (placeholder)
-    # Pass the structured_summary_text (string from OpenAI) to the Anthropic prompter
-    vis_prompt = generate_visualization_prompt_with_anthropic(structured_summary_text)
-    session['visualization_prompt'] = vis_prompt
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
 
-    image_filename_prefix = os.path.splitext(original_pdf_filename)[0]
-    generated_image_path = generate_image_with_ai(vis_prompt, base_filename_prefix=image_filename_prefix)
-    session['visualization_image_path'] = generated_image_path
+    def delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
 
-    return redirect(url_for('results')) # Changed from display_summary to results
+    def touch(self, name):
+        try:
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def iter_entries(self):
+        """Yields (name, last modified time) for every stored file."""
+        for entry in os.scandir(self.root):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                yield entry.name, entry.stat().st_mtime
+
+    def local_path(self, name):
+        """Path of the file on this host (for send_from_directory and CLI manifests)."""
+        return self._path(name)
+
+class SQLiteMediaStore:
+    """Stores files as blobs in a single SQLite database file."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS media (
+                                name TEXT PRIMARY KEY,
+                                data BLOB NOT NULL,
+                                created_at REAL NOT NULL)""")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def put(self, name, data):
+        _validate_media_name(name)
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO media (name, data, created_at) VALUES (?, ?, ?)", (name, data, time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, name):
+        _validate_media_name(name)
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT data FROM media WHERE name = ?", (name,)).fetchone()
+            return bytes(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def exists(self, name):
+        _validate_media_name(name)
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT 1 FROM media WHERE name = ?", (name,)).fetchone() is not None
+        finally:
+            conn.close()
 
-@app.route('/results') # Renamed from display_summary
-def results():
-    summary_text = session.get('structured_summary_text', 'No summary generated.')
-    saved_details = session.get('saved_summary_details', {}) # e.g. {'md': {'filename': '...'}, ...}
-    vis_prompt = session.get('visualization_prompt', 'No visualization prompt generated.')
-    image_path = session.get('visualization_image_path', None)
+    def delete(self, name):
+        _validate_media_name(name)
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM media WHERE name = ?", (name,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def touch(self, name):
+        _validate_media_name(name)
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE media SET created_at = ? WHERE name = ?", (time.time(), name))
+            conn.commit()
+        finally:
+            conn.close()
 
-    parsed_summary = parse_structured_summary(summary_text)
+    def iter_entries(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT name, created_at FROM media").fetchall()
+        finally:
+            conn.close()
+
+    def local_path(self, name):
+        return None
+
+MEDIA_STORE_BACKENDS = {
+    'local': LocalMediaStore,
+    'sqlite': SQLiteMediaStore,
+}
+
+_media_store = None
+_media_store_lock = threading.Lock()
+
+def get_media_store():
+    """Returns the process-wide media store configured by MEDIA_STORE/MEDIA_STORE_PATH."""
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None:
+            backend = app.config['MEDIA_STORE']
+            if backend not in MEDIA_STORE_BACKENDS:
+                raise ValueError(f"Unknown MEDIA_STORE backend: {backend!r} (expected one of {sorted(MEDIA_STORE_BACKENDS)})")
+            _media_store = MEDIA_STORE_BACKENDS[backend](app.config['MEDIA_STORE_PATH'])
+        return _media_store
+
+# Images are stored content-addressed: <sha256>.<ext> holds the bytes as generated, with a
+# WebP rendition (<sha256>.full.webp) and a WebP thumbnail (<sha256>.thumb.webp) next to it.
+# Identical images (such as the placeholder) are stored once, and because a name never
+# changes content, /media serves these files with immutable cache headers. Files not stored
+# or reused for MEDIA_MAX_AGE_SECONDS are garbage-collected.
+CONTENT_ADDRESSED_MEDIA_RE = re.compile(r'^([0-9a-f]{64})\.(?:full\.webp|thumb\.webp|[a-z]+)$')
+LEGACY_MEDIA_RE = re.compile(r'^.+_visualization_\d{8}_\d{6}\.png$') # Timestamped copies from before content addressing
+IMAGE_FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp', 'GIF': 'gif'}
+MEDIA_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+_media_lock = threading.Lock()
+_media_last_gc = 0.0
+
+def media_variant_names(name):
+    """{'original', 'webp', 'thumbnail'} media names for an image; variants are None for legacy images."""
+    match = CONTENT_ADDRESSED_MEDIA_RE.match(name or '')
+    if not match:
+        return {'original': name, 'webp': None, 'thumbnail': None}
+    digest = match.group(1)
+    return {'original': name, 'webp': f"{digest}.full.webp", 'thumbnail': f"{digest}.thumb.webp"}
+
+def store_image(image_bytes):
+    """
+    Stores image bytes (and their WebP variants) in the media store under their SHA-256
+    and returns the media name of the original. Raises ValueError for unsupported formats.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    media_store = get_media_store()
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        extension = IMAGE_FORMAT_EXTENSIONS.get(img.format)
+        if extension is None:
+            raise ValueError(f"Unsupported image format: {img.format}")
+        variants = media_variant_names(f"{digest}.{extension}")
+        if media_store.exists(variants['original']):
+            for name in variants.values():
+                media_store.touch(name) # Keeps a reused image from being garbage-collected
+            metrics_inc('media_images_total', result='deduplicated')
+            return variants['original']
+
+        has_alpha = img.mode in ('RGBA', 'LA') or 'transparency' in img.info
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+        full_buffer = io.BytesIO()
+        img.save(full_buffer, 'WEBP', quality=app.config['MEDIA_WEBP_QUALITY'], method=6)
+        img.thumbnail((app.config['MEDIA_THUMBNAIL_SIZE'], app.config['MEDIA_THUMBNAIL_SIZE']))
+        thumbnail_buffer = io.BytesIO()
+        img.save(thumbnail_buffer, 'WEBP', quality=app.config['MEDIA_WEBP_QUALITY'], method=6)
+
+    media_store.put(variants['webp'], full_buffer.getvalue())
+    media_store.put(variants['thumbnail'], thumbnail_buffer.getvalue())
+    media_store.put(variants['original'], image_bytes) # Written last: if it exists, so do its variants
+    metrics_inc('media_images_total', result='stored')
+    return variants['original']
+
+def gc_media(max_age_seconds):
+    """Deletes generated images (with their variants) not stored or reused within max_age_seconds."""
+    cutoff = time.time() - max_age_seconds
+    media_store = get_media_store()
+    removed = 0
+    for name, modified_at in list(media_store.iter_entries()):
+        if modified_at < cutoff and (CONTENT_ADDRESSED_MEDIA_RE.match(name) or LEGACY_MEDIA_RE.match(name)):
+            media_store.delete(name)
+            removed += 1
+    return removed
+
+def maybe_gc_media():
+    """Runs gc_media at most once per MEDIA_GC_INTERVAL seconds; called on new uploads."""
+    global _media_last_gc
+    now = time.time()
+    with _media_lock:
+        if now - _media_last_gc < app.config['MEDIA_GC_INTERVAL']:
+            return
+        _media_last_gc = now
+    try:
+        removed = gc_media(app.config['MEDIA_MAX_AGE_SECONDS'])
+        if removed:
+            print(f"Media store: removed {removed} unused image file(s).")
+    except Exception as e:
+        print(f"Media store garbage collection failed: {e}")
+# --- End Media Store ---
+
+# --- Near-Duplicate Detection ---
+# A revised version of a paper (arXiv v2, a new cover page) has a different hash, so the
+# result cache misses it. Every successfully processed paper is therefore also indexed by a
+# MinHash signature of its extracted text, bucketed with LSH. A new upload whose estimated
+# Jaccard similarity to an indexed paper is at least NEAR_DUPLICATE_THRESHOLD can reuse (or
+# be compared with) the earlier summary. Signatures are persisted in SQLite and loaded into
+# memory on first use; rows added or removed by other processes are picked up incrementally.
+# Entries are keyed by the result cache key and removed when the cache evicts that result,
+# so the index never grows past the cache and a reused result always has its image.
+MINHASH_SIZE = 128 # Signature length
+LSH_BANDS = 32 # 4 signature values per band
+SHINGLE_WORDS = 5
+_MINHASH_BIN_BITS = 57 # 64-bit shingle hash = 7 bits of bin + 57 bits of value
+
+def minhash_signature(text):
+    """
+    One-permutation MinHash of the text's word 5-gram shingles, with rotation densification
+    for empty bins. Linear in the text length. Returns None for texts with no words.
+    """
+    words = re.findall(r'[a-z0-9]+', text.lower())
+    if not words:
+        return None
+    bins = [None] * MINHASH_SIZE
+    for i in range(max(1, len(words) - SHINGLE_WORDS + 1)):
+        shingle = " ".join(words[i:i + SHINGLE_WORDS]).encode('utf-8')
+        h = int.from_bytes(hashlib.blake2b(shingle, digest_size=8).digest(), 'little')
+        b, value = h >> _MINHASH_BIN_BITS, h & ((1 << _MINHASH_BIN_BITS) - 1)
+        if bins[b] is None or value < bins[b]:
+            bins[b] = value
+    signature = []
+    for b in range(MINHASH_SIZE):
+        offset = 0
+        while bins[(b + offset) % MINHASH_SIZE] is None:
+            offset += 1
+        signature.append(bins[(b + offset) % MINHASH_SIZE] + (offset << _MINHASH_BIN_BITS))
+    return signature
+
+def _lsh_band_keys(signature):
+    rows = MINHASH_SIZE // LSH_BANDS
+    return [(band, tuple(signature[band * rows:(band + 1) * rows])) for band in range(LSH_BANDS)]
+
+class NearDuplicateIndex:
+    """MinHash/LSH index over processed papers, persisted in a SQLite file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.signatures = {} # entry id -> signature
+        self.buckets = {} # (band, band values) -> set of entry ids
+        self.loaded_rowid = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS papers (
+                                id TEXT PRIMARY KEY,
+                                signature BLOB NOT NULL,
+                                payload TEXT NOT NULL,
+                                created_at REAL NOT NULL)""")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _remove_in_memory(self, entry_id):
+        old = self.signatures.pop(entry_id, None)
+        if old is not None:
+            for key in _lsh_band_keys(old):
+                bucket = self.buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(entry_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def _insert_in_memory(self, entry_id, signature):
+        self._remove_in_memory(entry_id)
+        self.signatures[entry_id] = signature
+        for key in _lsh_band_keys(signature):
+            self.buckets.setdefault(key, set()).add(entry_id)
+
+    def refresh(self):
+        """Loads rows written, and drops rows removed, since the last refresh (by this or another process)."""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT rowid, id, signature FROM papers WHERE rowid > ? ORDER BY rowid",
+                                (self.loaded_rowid,)).fetchall()
+            count = conn.execute("SELECT COUNT(*) FROM papers").fetchone()[0]
+            with self.lock:
+                for rowid, entry_id, blob in rows:
+                    self._insert_in_memory(entry_id, list(array('Q', blob)))
+                    self.loaded_rowid = max(self.loaded_rowid, rowid)
+                # More papers in memory than on disk means some were removed elsewhere.
+                if len(self.signatures) > count:
+                    stored = {entry_id for (entry_id,) in conn.execute("SELECT id FROM papers")}
+                    for entry_id in set(self.signatures) - stored:
+                        self._remove_in_memory(entry_id)
+        finally:
+            conn.close()
+
+    def add(self, entry_id, signature, payload):
+        conn = self._connect()
+        try:
+            # Replacing the row gives it a new rowid, so other processes pick up the change too.
+            conn.execute("DELETE FROM papers WHERE id = ?", (entry_id,))
+            conn.execute("INSERT INTO papers (id, signature, payload, created_at) VALUES (?, ?, ?, ?)",
+                         (entry_id, array('Q', signature).tobytes(), json.dumps(payload), time.time()))
+            conn.commit()
+        finally:
+            conn.close()
+        with self.lock:
+            self._insert_in_memory(entry_id, signature)
+
+    def remove(self, entry_ids):
+        conn = self._connect()
+        try:
+            conn.executemany("DELETE FROM papers WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+            conn.commit()
+        finally:
+            conn.close()
+        with self.lock:
+            for entry_id in entry_ids:
+                self._remove_in_memory(entry_id)
+
+    def query(self, signature, threshold):
+        """Returns (entry id, estimated similarity) of the most similar paper at or above threshold, or None."""
+        with self.lock:
+            candidates = set()
+            for key in _lsh_band_keys(signature):
+                candidates.update(self.buckets.get(key, ()))
+            best = None
+            for entry_id in candidates:
+                other = self.signatures[entry_id]
+                similarity = sum(1 for a, b in zip(signature, other) if a == b) / MINHASH_SIZE
+                if similarity >= threshold and (best is None or similarity > best[1]):
+                    best = (entry_id, similarity)
+            return best
+
+    def get_payload(self, entry_id):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT payload, created_at FROM papers WHERE id = ?", (entry_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        payload = json.loads(row[0])
+        payload['indexed_at'] = datetime.fromtimestamp(row[1]).isoformat(timespec='seconds')
+        return payload
+
+_near_duplicate_index = None
+_near_duplicate_index_lock = threading.Lock()
+
+def get_near_duplicate_index():
+    global _near_duplicate_index
+    with _near_duplicate_index_lock:
+        if _near_duplicate_index is None:
+            started = time.perf_counter()
+            _near_duplicate_index = NearDuplicateIndex(app.config['NEAR_DUPLICATE_INDEX_PATH'])
+            _near_duplicate_index.refresh()
+            print(f"Near-duplicate index: loaded {len(_near_duplicate_index.signatures)} papers "
+                  f"in {time.perf_counter() - started:.3f}s")
+        return _near_duplicate_index
+
+def find_near_duplicate(extracted_text):
+    """Returns {'id', 'similarity', 'original_filename', 'indexed_at'} for a similar earlier paper, or None."""
+    if app.config['NEAR_DUPLICATE_POLICY'] == 'off':
+        return None
+    signature = minhash_signature(extracted_text)
+    if signature is None:
+        return None
+    index = get_near_duplicate_index()
+    index.refresh()
+    started = time.perf_counter()
+    match = index.query(signature, app.config['NEAR_DUPLICATE_THRESHOLD'])
+    metrics_observe('near_duplicate_query_seconds', time.perf_counter() - started)
+    if match is None:
+        return None
+    payload = index.get_payload(match[0])
+    if payload is None:
+        return None
+    metrics_inc('near_duplicate_matches_total')
+    return {'id': match[0], 'similarity': round(match[1], 3),
+            'original_filename': payload['original_filename'], 'indexed_at': payload['indexed_at']}
+
+def near_duplicate_result(entry_id):
+    """
+    Returns the pipeline result of an indexed paper from the result cache, which also
+    restores its image if the media store has garbage-collected it. None if it is gone.
+    """
+    cached = result_cache_get(entry_id)
+    if cached is None:
+        get_near_duplicate_index().remove([entry_id]) # Indexed before its cache entry was lost
+        return None
+    return cached['result']
+
+def index_processed_paper(entry_id, extracted_text, original_pdf_filename, result):
+    """
+    Adds a successfully processed paper to the near-duplicate index. entry_id is its
+    result cache key: the paper stays indexed only while its cached result exists.
+    """
+    if app.config['NEAR_DUPLICATE_POLICY'] == 'off':
+        return
+    signature = minhash_signature(extracted_text)
+    if signature is None:
+        return
+    get_near_duplicate_index().add(entry_id, signature, {
+        'original_filename': original_pdf_filename,
+        'result': {key: result.get(key) for key in ('structured_summary_text', 'visualization_prompt', 'visualization_image_path')},
+    })
+# --- End Near-Duplicate Detection ---
+
+# --- Summary Search ---
+# Full-text index (SQLite FTS5) over every generated summary: its parsed sections, the
+# original filename and the visualization prompt. Summaries are keyed by the result cache
+# key, so re-uploading the same PDF updates the entry (and its upload link) instead of
+# adding a duplicate. The index is updated as jobs finish; queries are ranked with BM25.
+# The full summary text is stored with each entry, so its downloads keep working after the
+# upload's artifacts expire, and for papers summarized by the batch command.
+SEARCH_MAX_PER_PAGE = 100
+
+def _search_index_connect():
+    os.makedirs(os.path.dirname(app.config['SEARCH_INDEX_PATH']) or '.', exist_ok=True)
+    conn = sqlite3.connect(app.config['SEARCH_INDEX_PATH'], timeout=30)
+    conn.execute("""CREATE TABLE IF NOT EXISTS summaries (
+                        key TEXT PRIMARY KEY,
+                        upload_id TEXT,
+                        original_filename TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        summary_text TEXT)""")
+    if 'summary_text' not in {row[1] for row in conn.execute("PRAGMA table_info(summaries)")}:
+        conn.execute("ALTER TABLE summaries ADD COLUMN summary_text TEXT") # Indexes created before downloads by key
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS summaries_fts USING fts5(
+                        original_filename, visualization_prompt, sections,
+                        tokenize = 'porter unicode61', prefix = '2 3')""")
+    return conn
+
+def _summary_sections_text(summary_text):
+    """Flattens the parsed summary into 'Section: content' lines for indexing."""
+    sections = parse_structured_summary(summary_text)
+    if 'Full Summary' in sections:
+        return sections['Full Summary']
+    return "\n".join(f"{section}: {content}" for section, content in sections.items())
+
+def index_summary(key, original_pdf_filename, result, upload_id=None):
+    """Adds or replaces the search entry for a summary; error results are not indexed."""
+    summary_text = result.get('structured_summary_text')
+    if not key or not summary_text or summary_text.startswith("Error:"):
+        return
+    visualization_prompt = result.get('visualization_prompt') or ''
+    if visualization_prompt.startswith("Error:"):
+        visualization_prompt = ''
+    conn = _search_index_connect()
+    try:
+        with conn: # One transaction, so the two tables never disagree
+            row = conn.execute("SELECT rowid FROM summaries WHERE key = ?", (key,)).fetchone()
+            if row:
+                rowid = row[0]
+                conn.execute("UPDATE summaries SET upload_id = COALESCE(?, upload_id), original_filename = ?, created_at = ?, "
+                             "summary_text = ? WHERE rowid = ?",
+                             (upload_id, original_pdf_filename, time.time(), summary_text, rowid))
+                conn.execute("DELETE FROM summaries_fts WHERE rowid = ?", (rowid,))
+            else:
+                rowid = conn.execute("INSERT INTO summaries (key, upload_id, original_filename, created_at, summary_text) "
+                                     "VALUES (?, ?, ?, ?, ?)",
+                                     (key, upload_id, original_pdf_filename, time.time(), summary_text)).lastrowid
+            conn.execute("INSERT INTO summaries_fts (rowid, original_filename, visualization_prompt, sections) VALUES (?, ?, ?, ?)",
+                         (rowid, original_pdf_filename, visualization_prompt, _summary_sections_text(summary_text)))
+    finally:
+        conn.close()
+
+def get_indexed_summary(key):
+    """Returns {'original_filename', 'summary_text'} of a search entry, or None if unknown or stored without its text."""
+    conn = _search_index_connect()
+    try:
+        row = conn.execute("SELECT original_filename, summary_text FROM summaries WHERE key = ?", (key,)).fetchone()
+    finally:
+        conn.close()
+    if row is None or row[1] is None:
+        return None
+    return {'original_filename': row[0], 'summary_text': row[1]}
+
+def _fts_match_expression(query):
+    """
+    Turns free text into an FTS5 expression: every word must match, the last one as a
+    prefix (for search-as-you-type). Quoting each word keeps FTS5 operators out of user input.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return " ".join(terms)
+
+def search_summaries(query, page=1, per_page=20):
+    """Returns (total matches, list of result dicts for the page), best matches first."""
+    match = _fts_match_expression(query)
+    if match is None:
+        return 0, []
+    started = time.perf_counter()
+    conn = _search_index_connect()
+    try:
+        total = conn.execute("SELECT COUNT(*) FROM summaries_fts WHERE summaries_fts MATCH ?", (match,)).fetchone()[0]
+        # bm25() weights: filename matches count most, then summary sections, then the prompt.
+        rows = conn.execute("""SELECT s.key, s.upload_id, s.original_filename, s.created_at, s.summary_text IS NOT NULL,
+                                      snippet(summaries_fts, 2, '**', '**', '...', 24),
+                                      bm25(summaries_fts, 4.0, 1.0, 2.0) AS score
+                               FROM summaries_fts JOIN summaries s ON s.rowid = summaries_fts.rowid
+                               WHERE summaries_fts MATCH ?
+                               ORDER BY score LIMIT ? OFFSET ?""",
+                            (match, per_page, (page - 1) * per_page)).fetchall()
+    finally:
+        conn.close()
+    metrics_observe('search_query_seconds', time.perf_counter() - started)
+    results = [{
+        'key': key,
+        'upload_id': upload_id,
+        'original_filename': original_filename,
+        'created_at': datetime.fromtimestamp(created_at).isoformat(timespec='seconds'),
+        'snippet': snippet,
+        'score': round(-score, 4), # bm25() is lower-is-better; report higher-is-better
+        'has_summary_text': bool(has_summary_text),
+    } for key, upload_id, original_filename, created_at, has_summary_text, snippet, score in rows]
+    return total, results
+# --- End Summary Search ---
+
+# --- Result Cache ---
+# Re-uploading the same PDF should not pay for extraction and three provider calls again.
+# Results are stored in SQLite keyed by a hash of the PDF bytes plus the pipeline version,
+# together with the bytes of the image so it can be restored if the file in static/images/
+# has been removed in the meantime. Document exports are re-rendered from the summary on demand.
+_result_cache_lock = threading.Lock()
+_result_cache_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+def _result_cache_connect():
+    conn = sqlite3.connect(app.config['RESULT_CACHE_PATH'], timeout=30)
+    conn.execute("""CREATE TABLE IF NOT EXISTS results (
+                        key TEXT PRIMARY KEY,
+                        payload TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS artifacts (
+                        key TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        data BLOB NOT NULL,
+                        PRIMARY KEY (key, path))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+    return conn
+
+def result_cache_key(pdf_bytes):
+    """Content hash of the PDF combined with everything that changes the pipeline output."""
+    h = hashlib.sha256()
+    h.update(f"{PIPELINE_VERSION}|{OPENAI_SUMMARY_MODEL}|{ANTHROPIC_PROMPT_MODEL}|"
+             f"{app.config['CONDENSE_TEXT']}|{app.config['SUMMARY_CHUNK_TOKENS']}|".encode('utf-8'))
+    h.update(pdf_bytes)
+    return h.hexdigest()
+
+def _result_media_names(result):
+    """Names of the media store files a pipeline result refers to."""
+    image_name = result.get('visualization_image_path')
+    return [image_name] if image_name else []
+
+def result_cache_get(key):
+    """Returns the cached entry ({'extracted_text', 'result'}) for key, or None on a miss."""
+    with _result_cache_lock:
+        conn = _result_cache_connect()
+        try:
+            row = conn.execute("SELECT payload FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                _result_cache_stats['misses'] += 1
+                return None
+            entry = json.loads(row[0])
+            # Restore any media file that has been deleted since the entry was stored.
+            media_names = _result_media_names(entry['result'])
+            media_store = get_media_store()
+            for stored_name, data in conn.execute("SELECT path, data FROM artifacts WHERE key = ?", (key,)):
+                if stored_name in media_names and not media_store.exists(stored_name):
+                    if CONTENT_ADDRESSED_MEDIA_RE.match(stored_name):
+                        store_image(data) # Also recreates the WebP variants
+                    else:
+                        media_store.put(stored_name, data)
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            _result_cache_stats['hits'] += 1
+            return entry
+        finally:
+            conn.close()
+
+def result_cache_put(key, extracted_text, result):
+    """Stores a finished pipeline result and evicts least recently used entries if over budget."""
+    payload = json.dumps({'extracted_text': extracted_text, 'result': result})
+    artifacts = []
+    for name in _result_media_names(result):
+        data = get_media_store().get(name)
+        if data is None:
+            print(f"Result cache: media file {name} is missing")
+        else:
+            artifacts.append((name, data))
+    size = len(payload.encode('utf-8')) + sum(len(data) for _, data in artifacts)
+    now = time.time()
+
+    with _result_cache_lock:
+        conn = _result_cache_connect()
+        try:
+            conn.execute("DELETE FROM artifacts WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO results (key, payload, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                         (key, payload, size, now, now))
+            conn.executemany("INSERT INTO artifacts (key, path, data) VALUES (?, ?, ?)",
+                             [(key, stored_path, data) for stored_path, data in artifacts])
+            _result_cache_stats['stores'] += 1
+
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            max_bytes = app.config['RESULT_CACHE_MAX_BYTES']
+            evicted = []
+            if total > max_bytes:
+                for old_key, old_size in conn.execute("SELECT key, size FROM results ORDER BY last_access").fetchall():
+                    if total <= max_bytes:
+                        break
+                    conn.execute("DELETE FROM results WHERE key = ?", (old_key,))
+                    conn.execute("DELETE FROM artifacts WHERE key = ?", (old_key,))
+                    evicted.append(old_key)
+                    total -= old_size
+                    _result_cache_stats['evictions'] += 1
+            conn.commit()
+        finally:
+            conn.close()
+    if evicted:
+        # Near-duplicate entries are keyed by the cache key and reuse the cached result.
+        get_near_duplicate_index().remove(evicted)
+
+def is_cacheable_result(result):
+    """Mock or fake-backend summaries, failed stages and provider error strings must not be served from cache."""
+    if use_fake_llm_backend() or not app.config.get('OPENAI_API_KEY') or result.get('stage_errors'):
+        return False
+    for field in ('structured_summary_text', 'visualization_prompt'):
+        value = result.get(field)
+        if not isinstance(value, str) or value.startswith("Error:"):
+            return False
+    return True
+
+def result_cache_stats():
+    with _result_cache_lock:
+        stats = dict(_result_cache_stats)
+        conn = _result_cache_connect()
+        try:
+            stats['entries'], stats['bytes'] = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        finally:
+            conn.close()
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+    stats['max_bytes'] = app.config['RESULT_CACHE_MAX_BYTES']
+    return stats
+# --- End Result Cache ---
+
+# --- Background Jobs ---
+# The summarize/visualize pipeline makes several slow LLM round-trips, so it runs on a
+# worker pool instead of inside the request. Each upload gets a job id right away and
+# the browser polls /results (or /jobs/<job_id>) until the job is done. Job records live in
+# a job store so that, with JOB_STORE=sqlite, any worker process on the host can report on
+# any job, and with JOB_STORE=file, any process on any host can.
+_jobs_lock = threading.Lock()
+_job_store = None
+_job_executor = None
+_stage_executor = None
+
+class MemoryJobStore:
+    """Job records held by this process; enough for a single-process deployment."""
+
+    def __init__(self):
+        self.jobs = {}
+        self.changed = threading.Condition() # Notified on every job update; used by the SSE stream
+
+    def create(self, record):
+        with self.changed:
+            self.jobs[record['id']] = record
+            self._prune_finished()
+            self.changed.notify_all()
+
+    def _prune_finished(self):
+        # Records are kept in creation order, so the first finished ones are the oldest.
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - app.config['JOB_MAX_FINISHED'])]:
+            del self.jobs[job_id]
+
+    def update(self, job_id, **fields):
+        with self.changed:
+            self.jobs[job_id].update(fields)
+            self.changed.notify_all()
+
+    def append_summary_partial(self, job_id, text):
+        with self.changed:
+            self.jobs[job_id]['summary_partial'] += text
+            self.changed.notify_all()
+
+    def get(self, job_id):
+        with self.changed:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait_for(self, job_id, predicate, timeout):
+        """Blocks until predicate(job snapshot or None) is true or timeout passes; returns the snapshot."""
+        with self.changed:
+            self.changed.wait_for(lambda: predicate(self.jobs.get(job_id)), timeout=timeout)
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def count_by_status(self):
+        with self.changed:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return counts
+
+    def cleanup(self, ttl_seconds):
+        """Forgets finished jobs older than ttl_seconds."""
+        cutoff = datetime.fromtimestamp(time.time() - ttl_seconds).isoformat()
+        with self.changed:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job['status'] in ('done', 'failed') and (job['finished_at'] or '') < cutoff]
+            for job_id in expired:
+                del self.jobs[job_id]
+            return len(expired)
+
+class PolledJobStore:
+    """
+    Shared behaviour of the job stores that other processes write to (sqlite, file):
+    waiters poll every JOB_POLL_SECONDS, and streamed summary tokens are buffered and
+    written every JOB_PARTIAL_FLUSH_SECONDS. Subclasses provide _modify(job_id, change).
+    """
+
+    def __init__(self):
+        self.changed = threading.Condition() # Wakes waiters early for updates made by this process
+        self.partials = {} # job id -> summary tokens not yet written
+        self.partials_lock = threading.Lock()
+        # Held from taking a job's buffered tokens until they are written, so flushes of one
+        # job are written in order. Striped by job id instead of one lock per job.
+        self.flush_locks = [threading.Lock() for _ in range(64)]
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def _take_partial(self, job_id):
+        with self.partials_lock:
+            return "".join(self.partials.pop(job_id, ()))
+
+    def _flush_lock(self, job_id):
+        return self.flush_locks[hash(job_id) % len(self.flush_locks)]
+
+    def update(self, job_id, **fields):
+        with self._flush_lock(job_id):
+            partial = self._take_partial(job_id) # Written first, so no tokens land after the final update
+            def _update(record):
+                record['summary_partial'] += partial
+                record.update(fields)
+            self._modify(job_id, _update)
+
+    def append_summary_partial(self, job_id, text):
+        """Buffers streamed tokens and writes them every JOB_PARTIAL_FLUSH_SECONDS instead of per token."""
+        with self.partials_lock:
+            if job_id in self.partials:
+                self.partials[job_id].append(text)
+                return
+            self.partials[job_id] = [text]
+        timer = threading.Timer(app.config['JOB_PARTIAL_FLUSH_SECONDS'], self._flush_partial, (job_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _flush_partial(self, job_id):
+        with self._flush_lock(job_id):
+            partial = self._take_partial(job_id)
+            if not partial:
+                return
+            def _append(record):
+                record['summary_partial'] += partial
+            try:
+                self._modify(job_id, _append)
+            except KeyError:
+                pass # Job pruned in the meantime
+
+    def wait_for(self, job_id, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if predicate(job) or remaining <= 0:
+                return job
+            with self.changed:
+                self.changed.wait(min(remaining, app.config['JOB_POLL_SECONDS']))
+
+class SQLiteJobStore(PolledJobStore):
+    """
+    Job records in a SQLite file shared by the worker processes of one host (WAL mode is not
+    safe on network filesystems), so any of them can answer /results, /jobs/<job_id> and
+    the event stream for a job another one is running. Waiters poll every JOB_POLL_SECONDS.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id TEXT PRIMARY KEY,
+                                status TEXT NOT NULL,
+                                record TEXT NOT NULL,
+                                updated_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated_at ON jobs (status, updated_at)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def create(self, record):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT INTO jobs (id, status, record, updated_at) VALUES (?, ?, ?, ?)",
+                         (record['id'], record['status'], json.dumps(record), time.time()))
+            conn.execute("""DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN (
+                                SELECT id FROM jobs WHERE status IN ('done', 'failed')
+                                ORDER BY updated_at DESC LIMIT ?)""", (app.config['JOB_MAX_FINISHED'],))
+        finally:
+            conn.close()
+        self._notify()
+
+    def _modify(self, job_id, change):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE") # Serializes read-modify-write across processes
+            row = conn.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                raise KeyError(job_id)
+            record = json.loads(row[0])
+            change(record)
+            conn.execute("UPDATE jobs SET status = ?, record = ?, updated_at = ? WHERE id = ?",
+                         (record['status'], json.dumps(record), time.time(), job_id))
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        self._notify()
+
+    def get(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT record FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def count_by_status(self):
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        finally:
+            conn.close()
+
+    def cleanup(self, ttl_seconds):
+        conn = self._connect()
+        try:
+            cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                                  (time.time() - ttl_seconds,))
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+class FileJobStore(PolledJobStore):
+    """
+    One JSON file per job in a directory that every host mounts (e.g. NFS), so any host
+    behind a load balancer can answer /results, /jobs/<job_id> and the event stream for a
+    job another one is running. Files are replaced atomically with os.replace, like local
+    artifacts. A job is only written by the process that created or runs it, so no
+    cross-host locking is needed.
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        self.lock = threading.Lock() # Serializes read-modify-write within this process
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, job_id):
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        return os.path.join(self.root, f"{job_id}.json")
+
+    def _read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, record):
+        path = self._path(record['id'])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path) # Readers on every host see the old or the new record, never a mix
+
+    def create(self, record):
+        with self.lock:
+            self._write(record)
+        self._notify()
+
+    def _modify(self, job_id, change):
+        path = self._path(job_id)
+        with self.lock:
+            record = self._read(path) if path else None
+            if record is None:
+                raise KeyError(job_id)
+            change(record)
+            self._write(record)
+        self._notify()
+
+    def get(self, job_id):
+        path = self._path(job_id)
+        return self._read(path) if path else None
+
+    def _records(self):
+        """Yields (path, record, modified time) for every job file."""
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith('.json'):
+                continue
+            try:
+                modified = entry.stat().st_mtime
+                record = self._read(entry.path)
+            except (OSError, ValueError):
+                continue # Removed or replaced by another host meanwhile
+            if record is not None:
+                yield entry.path, record, modified
+
+    def count_by_status(self):
+        counts = {}
+        for _, record, _ in self._records():
+            counts[record['status']] = counts.get(record['status'], 0) + 1
+        return counts
+
+    def cleanup(self, ttl_seconds):
+        """Removes finished jobs older than ttl_seconds, then all but the newest JOB_MAX_FINISHED."""
+        cutoff = time.time() - ttl_seconds
+        finished = sorted(((modified, path) for path, record, modified in self._records()
+                           if record['status'] in ('done', 'failed')), reverse=True)
+        expired = [path for index, (modified, path) in enumerate(finished)
+                   if modified < cutoff or index >= app.config['JOB_MAX_FINISHED']]
+        for path in expired:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(expired)
+
+JOB_STORE_BACKENDS = {
+    'memory': lambda path: MemoryJobStore(),
+    'sqlite': SQLiteJobStore,
+    'file': FileJobStore,
+}
+
+def get_job_store():
+    """Returns the process-wide job store configured by JOB_STORE/JOB_STORE_PATH."""
+    global _job_store
+    with _jobs_lock:
+        if _job_store is None:
+            backend = app.config['JOB_STORE']
+            if backend not in JOB_STORE_BACKENDS:
+                raise ValueError(f"Unknown JOB_STORE backend: {backend!r} (expected one of {sorted(JOB_STORE_BACKENDS)})")
+            _job_store = JOB_STORE_BACKENDS[backend](app.config['JOB_STORE_PATH'])
+        return _job_store
+
+
+def _get_job_executor():
+    global _job_executor
+    with _jobs_lock:
+        if _job_executor is None:
+            _job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'],
+                                               thread_name_prefix='pipeline-job')
+        return _job_executor
+
+def _get_stage_executor():
+    global _stage_executor
+    with _jobs_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(max_workers=app.config['STAGE_WORKERS'],
+                                                 thread_name_prefix='pipeline-stage')
+        return _stage_executor
+
+def run_stage_graph(stages, context):
+    """
+    Runs a small dependency graph of pipeline stages on the shared stage pool.
+    stages maps a name to (dependencies, fn); fn receives the context dict with the
+    results of its dependencies already filled in and returns its own result, which is
+    stored in context under the stage name. A stage starts as soon as all of its
+    dependencies have finished. A failing stage does not stop independent stages; stages
+    depending on it are skipped.
+    Returns (timings, errors): seconds per stage that ran, and an error string per stage
+    that failed or was skipped.
+    """
+    timings, errors = {}, {}
+    remaining = dict(stages)
+    running = {}
+
+    def _timed(name, fn):
+        started = time.perf_counter()
+        try:
+            return fn(context)
+        finally:
+            elapsed = time.perf_counter() - started
+            timings[name] = round(elapsed, 4)
+            metrics_observe('pipeline_stage_seconds', elapsed, stage=name)
+
+    while remaining or running:
+        for name, (deps, fn) in list(remaining.items()):
+            failed_deps = [dep for dep in deps if dep in errors]
+            if failed_deps:
+                errors[name] = f"Skipped: dependency {', '.join(failed_deps)} failed."
+                del remaining[name]
+            elif all(dep in context for dep in deps):
+                running[submit_in_context(_get_stage_executor(), _timed, name, fn)] = name
+                del remaining[name]
+        if not running:
+            if remaining: # Unknown or circular dependencies would otherwise loop forever
+                for name in remaining:
+                    errors[name] = "Skipped: dependencies could not be satisfied."
+            break
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            try:
+                context[name] = future.result()
+            except Exception as e:
+                print(f"Pipeline stage '{name}' failed: {type(e).__name__} - {e}")
+                errors[name] = f"{type(e).__name__}: {e}"
+    for name in errors:
+        metrics_inc('pipeline_stage_errors_total', stage=name)
+    return timings, errors
+
+class ProviderStageError(RuntimeError):
+    """A pipeline stage whose provider helper reported a failure as an "Error: ..." string."""
+
+def _raise_on_error_string(result):
+    """The provider helpers return failures as "Error: ..." text; turn those into stage failures."""
+    if isinstance(result, str) and result.startswith("Error:"):
+        raise ProviderStageError(result[len("Error:"):].strip())
+    return result
+
+def run_summary_pipeline(extracted_text, original_pdf_filename, on_summary_token=None, on_summary_done=None):
+    """
+    Runs summary, visualization prompt and image generation for one paper as a stage
+    graph. Document exports are not produced here; they are rendered on download.
+    on_summary_token, if given, receives the summary text as it is streamed, and
+    on_summary_done the finished summary in a stage of its own that runs alongside the
+    visualization stages.
+    """
+    stages = {
+        'summary': ((), lambda ctx: _raise_on_error_string(summarize_text_with_ai(extracted_text, on_token=on_summary_token))),
+        # Pass the structured summary text (string from OpenAI) to the Anthropic prompter
+        'visualization_prompt': (('summary',), lambda ctx: _raise_on_error_string(generate_visualization_prompt_with_anthropic(ctx['summary']))),
+        'visualization_image': (('visualization_prompt',), lambda ctx: generate_image_with_ai(ctx['visualization_prompt'])),
+    }
+    if on_summary_done:
+        stages['publish_summary'] = (('summary',), lambda ctx: on_summary_done(ctx['summary']))
+    context = {}
+    token_usage = {}
+    token_usage_scope = _job_token_usage.set(token_usage)
+    try:
+        timings, errors = run_stage_graph(stages, context)
+    finally:
+        _job_token_usage.reset(token_usage_scope)
+    print(f"Pipeline stage timings for {original_pdf_filename}: {timings}")
+    if 'summary' in errors:
+        raise RuntimeError(f"Summary stage failed: {errors['summary']}")
+
+    return {
+        'structured_summary_text': context.get('summary'),
+        'visualization_prompt': context.get('visualization_prompt'),
+        'visualization_image_path': context.get('visualization_image'),
+        'stage_timings': timings,
+        'stage_errors': errors,
+        'token_usage': token_usage, # e.g. {'openai': {'prompt_tokens': ..., 'completion_tokens': ...}}
+    }
+
+def _run_job(job_id, upload_id, original_pdf_filename, cache_key=None):
+    _update_job(job_id, status='running', started_at=datetime.now().isoformat())
+    started = time.perf_counter()
+    try:
+        extracted_text = get_artifact_text(upload_id, 'extracted_text.txt')
+        if extracted_text is None: # Queued by queue_upload: hash and extract here
+            try:
+                ingest = ingest_upload(upload_id, original_pdf_filename)
+            finally:
+                get_artifact_store().delete(upload_id, 'original.pdf') # Extracted (or rejected); no longer needed
+            cache_key = ingest['cache_key']
+            if ingest['reused_result'] is not None:
+                reused_result = ingest['reused_result']
+                if reused_result.get('structured_summary_text'):
+                    get_artifact_store().put(upload_id, 'summary.txt', reused_result['structured_summary_text'])
+                _update_job(job_id, status='done', result=reused_result, cached=True,
+                            near_duplicate_of=ingest['near_duplicate_of'], finished_at=datetime.now().isoformat())
+                return
+            extracted_text = ingest['extracted_text']
+        on_summary_token = (lambda text: _append_summary_partial(job_id, text)) if app.config['STREAM_SUMMARY'] else None
+
+        def on_summary_done(summary):
+            # Runs alongside the Anthropic call, so downloads and search work before the image is ready.
+            get_artifact_store().put(upload_id, 'summary.txt', summary)
+            try:
+                index_summary(cache_key or upload_id, original_pdf_filename, {'structured_summary_text': summary},
+                              upload_id=upload_id)
+            except Exception as e_index:
+                print(f"Search index: could not index {original_pdf_filename}: {e_index}")
+            _update_job(job_id, summary_done=True)
+
+        result = run_summary_pipeline(extracted_text, original_pdf_filename, on_summary_token=on_summary_token,
+                                      on_summary_done=on_summary_done)
+        if cache_key and is_cacheable_result(result):
+            try:
+                result_cache_put(cache_key, extracted_text, result)
+                index_processed_paper(cache_key, extracted_text, original_pdf_filename, result)
+            except Exception as e_cache: # A cache or index failure must not fail the job
+                print(f"Result cache: could not store {cache_key}: {e_cache}")
+        try:
+            # Re-indexed with the visualization prompt, which was not ready when the summary was.
+            index_summary(cache_key or upload_id, original_pdf_filename, result, upload_id=upload_id)
+        except Exception as e_index: # Search indexing must not fail the job either
+            print(f"Search index: could not index {original_pdf_filename}: {e_index}")
+        _update_job(job_id, status='done', result=result, finished_at=datetime.now().isoformat())
+    except Exception as e:
+        print(f"Job {job_id} failed: {type(e).__name__} - {e}")
+        _update_job(job_id, status='failed', error=f"{type(e).__name__}: {e}",
+                    finished_at=datetime.now().isoformat())
+    finally:
+        elapsed = time.perf_counter() - started
+        _update_job(job_id, seconds=round(elapsed, 3))
+        job = get_job(job_id)
+        metrics_inc('jobs_total', status=job['status'])
+        metrics_observe('job_seconds', elapsed)
+        log_job_event(job)
+
+def _update_job(job_id, **fields):
+    get_job_store().update(job_id, **fields)
+
+def _append_summary_partial(job_id, text):
+    get_job_store().append_summary_partial(job_id, text)
+
+def _new_job_record(job_id, upload_id, original_pdf_filename):
+    return {
+        'id': job_id,
+        'upload_id': upload_id,
+        'status': 'queued', # queued -> running -> done | failed
+        'original_filename': original_pdf_filename,
+        'created_at': datetime.now().isoformat(),
+        'started_at': None,
+        'finished_at': None,
+        'result': None,
+        'error': None,
+        'cached': False,
+        'summary_partial': "", # Summary text streamed so far (STREAM_SUMMARY)
+        'summary_done': False, # The summary stage has finished; later stages may still run
+        'seconds': None,
+        'near_duplicate_of': None, # Index id of the earlier paper whose summary was reused
+    }
+
+def submit_job(upload_id, original_pdf_filename, cache_key=None):
+    """
+    Queues the pipeline for one upload whose extracted text is in the artifact store
+    and returns the new job id immediately.
+    """
+    job_id = uuid.uuid4().hex
+    get_job_store().create(_new_job_record(job_id, upload_id, original_pdf_filename))
+    _get_job_executor().submit(_run_job, job_id, upload_id, original_pdf_filename, cache_key)
+    return job_id
+
+def complete_job_from_cache(upload_id, cached_result, original_pdf_filename, near_duplicate_of=None):
+    """Registers an already finished job for a result served from the cache (or from a near-duplicate)."""
+    if cached_result.get('structured_summary_text'):
+        get_artifact_store().put(upload_id, 'summary.txt', cached_result['structured_summary_text'])
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    record = _new_job_record(job_id, upload_id, original_pdf_filename)
+    record.update(status='done', started_at=now, finished_at=now, result=cached_result, cached=True, seconds=0.0,
+                  near_duplicate_of=near_duplicate_of)
+    get_job_store().create(record)
+    metrics_inc('jobs_total', status='done')
+    log_job_event(record)
+    return job_id
+
+def get_job(job_id):
+    """Returns a snapshot of the job record, or None if the id is unknown."""
+    return get_job_store().get(job_id)
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def iter_job_events(job_id):
+    """
+    Server-Sent Events for one job: a 'section' event whenever a summary section's
+    (partial) content changes, then 'done' as soon as the summary is complete (the page
+    polls /jobs/<job_id> for the remaining stages), or 'failed'. Sends keep-alive comments
+    while idle.
+    """
+    parser = StructuredSummaryParser()
+    sent_chars = 0
+    sent_sections = {}
+    while True:
+        job = get_job_store().wait_for(
+            job_id,
+            lambda job: job is None
+                        or job['status'] not in ('queued', 'running')
+                        or job.get('summary_done')
+                        or len(job['summary_partial']) > sent_chars,
+            timeout=app.config['SSE_KEEPALIVE_SECONDS'])
+        status = job['status'] if job else None
+        new_text = job['summary_partial'][sent_chars:] if job else ""
+        if job is None:
+            yield _sse_event('failed', {'error': 'Unknown job id.'})
+            return
+
+        if new_text:
+            sent_chars += len(new_text)
+            parser.feed(new_text)
+            for section, content in parser.snapshot().items():
+                if sent_sections.get(section) != content:
+                    sent_sections[section] = content
+                    yield _sse_event('section', {'section': section, 'content': content})
+        elif status in ('queued', 'running'):
+            yield ": keep-alive\n\n"
+
+        if status == 'done' or job.get('summary_done'):
+            for section, content in parser.close().items(): # The last line may not end in a newline
+                if sent_sections.get(section) != content:
+                    yield _sse_event('section', {'section': section, 'content': content})
+            yield _sse_event('done', {'results_url': url_for('results', job_id=job_id),
+                                      'status_url': url_for('job_status', job_id=job_id)})
+            return
+        if status == 'failed':
+            yield _sse_event('failed', {'error': job['error']})
+            return
+# --- End Background Jobs ---
+
+@app.route('/process_and_summarize')
+def process_and_summarize():
+    upload_id = session.get('upload_id')
+    upload_info = get_artifact_json(upload_id, 'upload.json') if upload_id else None
+    if not upload_info or not get_artifact_store().exists(upload_id, 'extracted_text.txt'):
+        return redirect(url_for('upload_file'))
+    if upload_info.get('job_id') and get_job(upload_info['job_id']) is not None:
+        # A repeat request (reload, back button) shows the upload's job instead of paying for another.
+        session['job_id'] = upload_info['job_id']
+        return redirect(url_for('results'))
+
+    original_pdf_filename = upload_info.get('original_filename', 'uploaded_pdf')
+    session['job_id'] = submit_job(upload_id, original_pdf_filename, cache_key=upload_info.get('cache_key'))
+    upload_info['job_id'] = session['job_id']
+    get_artifact_store().put(upload_id, 'upload.json', json.dumps(upload_info))
+
+    return redirect(url_for('results')) # results shows a progress page until the job finishes
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id.'}), 404
+    return jsonify(job)
+
+@app.route('/near_duplicate/<upload_id>', methods=['GET', 'POST'])
+def near_duplicate(upload_id):
+    """Lets the user reuse the summary of a similar earlier paper instead of summarizing again."""
+    try:
+        upload_info = get_artifact_json(upload_id, 'upload.json')
+    except ValueError:
+        upload_info = None
+    match = upload_info.get('near_duplicate') if upload_info else None
+    payload = get_near_duplicate_index().get_payload(match['id']) if match else None
+    if payload is None:
+        return redirect(url_for('upload_file'))
 
-    md_fn = saved_details.get('md', {}).get('filename') if saved_details.get('md') else None
-    docx_fn = saved_details.get('docx', {}).get('filename') if saved_details.get('docx') else None
+    if request.method == 'POST':
+        session['upload_id'] = upload_id
+        if request.form.get('action') == 'reuse':
+            session['job_id'] = reuse_near_duplicate(upload_id, match['id'], upload_info['original_filename'],
+                                                     cache_key=upload_info.get('cache_key'))
+            return redirect(url_for('results'))
+        return redirect(url_for('process_and_summarize'))
+
+    return render_template('near_duplicate.html', upload_id=upload_id, upload_info=upload_info, match=match,
+                           summary_data=parse_structured_summary(payload['result'].get('structured_summary_text')))
+
+@app.route('/near_duplicate/<upload_id>/diff')
+def near_duplicate_diff(upload_id):
+    """Shows a side-by-side diff of this upload's summary against the earlier similar paper's."""
+    try:
+        upload_info = get_artifact_json(upload_id, 'upload.json')
+        summary_text = get_artifact_text(upload_id, 'summary.txt')
+    except ValueError:
+        upload_info, summary_text = None, None
+    match = upload_info.get('near_duplicate') if upload_info else None
+    payload = get_near_duplicate_index().get_payload(match['id']) if match else None
+    if payload is None or summary_text is None:
+        return redirect(url_for('upload_file'))
+    earlier_text = payload['result'].get('structured_summary_text') or ''
+    diff_table = difflib.HtmlDiff(wrapcolumn=70).make_table(
+        earlier_text.splitlines(), summary_text.splitlines(),
+        fromdesc=f"Earlier: {match['original_filename']}", todesc=f"This upload: {upload_info['original_filename']}")
+    return render_template('near_duplicate.html', upload_id=upload_id, upload_info=upload_info, match=match,
+                           diff_table=diff_table)
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    if get_job(job_id) is None:
+        return jsonify({'error': 'Unknown job id.'}), 404
+    return Response(stream_with_context(iter_job_events(job_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/artifacts/<upload_id>/<name>')
+def stream_artifact(upload_id, name):
+    """Streams a stored artifact (e.g. extracted_text.txt) in chunks."""
+    try:
+        artifact_store = get_artifact_store()
+        if not artifact_store.exists(upload_id, name):
+            return jsonify({'error': 'Unknown artifact.'}), 404
+    except ValueError:
+        return jsonify({'error': 'Invalid artifact reference.'}), 400
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if mimetype.startswith('text/'):
+        mimetype += '; charset=utf-8'
+    return Response(artifact_store.iter_chunks(upload_id, name), mimetype=mimetype)
+
+@app.route('/media/<name>')
+def media(name):
+    """Serves a generated image from the media store; content-addressed images are cached forever."""
+    try:
+        media_store = get_media_store()
+        local_path = media_store.local_path(name)
+        if local_path is not None:
+            response = send_from_directory(os.path.dirname(local_path), name)
+        else:
+            data = media_store.get(name)
+            if data is None:
+                return jsonify({'error': 'Unknown media file.'}), 404
+            response = Response(data, mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            response.set_etag(name)
+            response.make_conditional(request)
+    except ValueError:
+        return jsonify({'error': 'Invalid media name.'}), 400
+    if CONTENT_ADDRESSED_MEDIA_RE.match(name):
+        response.headers['Cache-Control'] = MEDIA_IMMUTABLE_CACHE_CONTROL
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(result_cache_stats())
+
+@app.route('/search')
+def search():
+    """Ranked full-text search over past summaries: /search?q=...&page=1&per_page=20."""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': "Missing search query parameter 'q'."}), 400
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(max(1, request.args.get('per_page', 20, type=int)), SEARCH_MAX_PER_PAGE)
+    started = time.perf_counter()
+    total, results = search_summaries(query, page=page, per_page=per_page)
+    for item in results:
+        item['downloads'] = {fmt: url_for('download_indexed_summary', key=item['key'], fmt=fmt)
+                             for fmt in EXPORT_FORMATS} if item.pop('has_summary_text') else {}
+    return jsonify({
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': (total + per_page - 1) // per_page,
+        'results': results,
+        'seconds': round(time.perf_counter() - started, 4),
+    })
 
-    # For display in template, could also pass full paths if needed for messages
-    # md_full_path = saved_details.get('md', {}).get('full_path')
-    # docx_full_path = saved_details.get('docx', {}).get('full_path')
+@app.route('/results') # Renamed from display_summary
+def results():
+    job_id = request.args.get('job_id') or session.get('job_id')
+    job = get_job(job_id) if job_id else None
+    if job is None:
+        return redirect(url_for('upload_file'))
+    if job['status'] in ('queued', 'running'):
+        if app.config['STREAM_SUMMARY']:
+            # result.html fills in the summary sections from /jobs/<job_id>/events as they stream in.
+            return render_template('result.html', streaming_job=job,
+                                   summary_data=None, visualization_prompt=None,
+                                   visualization_image_path=None, upload_id=None, export_formats={})
+        return render_template('processing.html', job=job)
+    if job['status'] == 'failed':
+        return render_template('result.html',
+                               summary_data={'Error': f"Processing failed: {job['error']}"},
+                               visualization_prompt=None,
+                               visualization_image_path=None,
+                               upload_id=None,
+                               export_formats={})
+
+    job_result = job['result']
+    summary_text = job_result.get('structured_summary_text') or 'No summary generated.'
+    vis_prompt = job_result.get('visualization_prompt') or 'No visualization prompt generated.'
+    image_path = job_result.get('visualization_image_path')
 
+    parsed_summary = parse_structured_summary(summary_text)
 
+    # Exports are rendered when a download link is first followed (see download_doc).
+    has_summary = bool(job_result.get('structured_summary_text'))
+    upload_info = get_artifact_json(job['upload_id'], 'upload.json') or {}
     return render_template('result.html',
+                           near_duplicate=upload_info.get('near_duplicate'),
+                           reused_near_duplicate=bool(job.get('near_duplicate_of')),
                            summary_data=parsed_summary,
                            visualization_prompt=vis_prompt,
                            visualization_image_path=image_path,
-                           md_filename=md_fn,
-                           docx_filename=docx_fn)
-
-@app.route('/download_doc/<path:filename>')
-def download_doc(filename):
-    return send_from_directory(DOCS_DIR, filename, as_attachment=True)
+                           image_variants=media_variant_names(image_path) if image_path else {},
+                           upload_id=job['upload_id'] if has_summary else None,
+                           export_formats=EXPORT_FORMATS if has_summary else {})
+
+# --- Batch Ingestion ---
+# Many PDFs at once: POST /batch takes several PDFs and/or zip archives of PDFs and queues a
+# job per paper (hashing and extraction happen in the job, so the request only stores the
+# PDFs); `flask --app app batch DIR` runs the same pipeline headless over a directory.
+def iter_batch_pdfs(files):
+    """
+    Yields (filename, pdf_bytes or None, error or None) for uploaded PDFs and for the PDFs
+    inside uploaded zip archives. Members over MAX_PDF_BYTES are reported, not read.
+    """
+    max_bytes = app.config['MAX_PDF_BYTES']
+    for file in files:
+        filename = secure_filename(file.filename or '')
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension == 'pdf':
+            data = file.read(max_bytes + 1)
+            if len(data) > max_bytes:
+                yield filename, None, f"Larger than MAX_PDF_BYTES ({max_bytes} bytes)."
+            else:
+                yield filename, data, None
+        elif extension == 'zip':
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    for member in archive.infolist():
+                        member_name = secure_filename(os.path.basename(member.filename))
+                        if member.is_dir() or member.filename.startswith('__MACOSX/') or not allowed_file(member_name):
+                            continue
+                        if member.file_size > max_bytes:
+                            yield member_name, None, f"Larger than MAX_PDF_BYTES ({max_bytes} bytes)."
+                            continue
+                        with archive.open(member) as member_file:
+                            yield member_name, member_file.read(max_bytes + 1), None
+            except zipfile.BadZipFile as e:
+                yield filename, None, f"Invalid zip archive: {e}"
+        else:
+            yield filename or '(unnamed)', None, "Not a PDF or zip file."
+
+@app.route('/batch', methods=['POST'])
+def batch_upload():
+    files = request.files.getlist('pdf_files')
+    if not files:
+        return jsonify({'error': "No files uploaded in 'pdf_files'."}), 400
+
+    entries = []
+    for filename, pdf_bytes, error in iter_batch_pdfs(files):
+        if len(entries) >= app.config['BATCH_MAX_FILES']:
+            entries.append({'filename': filename, 'upload_id': None, 'job_id': None,
+                            'error': f"Batch limit of {app.config['BATCH_MAX_FILES']} files reached."})
+            break
+        entry = {'filename': filename, 'upload_id': None, 'job_id': None, 'error': error}
+        if pdf_bytes is not None:
+            try:
+                entry['upload_id'], entry['job_id'] = queue_upload(pdf_bytes, filename)
+            except Exception as e:
+                print(f"Batch: could not ingest {filename}: {type(e).__name__} - {e}")
+                entry['error'] = f"{type(e).__name__}: {e}"
+        entries.append(entry)
+
+    batch_id = uuid.uuid4().hex
+    get_artifact_store().put(batch_id, 'batch.json', json.dumps(entries))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'batch_id': batch_id, 'status_url': url_for('batch_status', batch_id=batch_id), 'jobs': entries}), 202
+    return redirect(url_for('batch_status', batch_id=batch_id))
+
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    try:
+        entries = get_artifact_json(batch_id, 'batch.json')
+    except ValueError:
+        entries = None
+    if entries is None:
+        return jsonify({'error': 'Unknown batch id.'}), 404
+    for entry in entries:
+        job = get_job(entry['job_id']) if entry['job_id'] else None
+        entry['status'] = job['status'] if job else ('rejected' if entry['error'] else 'unknown')
+        image_name = (job.get('result') or {}).get('visualization_image_path') if job else None
+        entry['thumbnail'] = media_variant_names(image_name)['thumbnail'] if image_name else None
+    if request.args.get('format') == 'json' or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'batch_id': batch_id, 'jobs': entries})
+    pending = sum(1 for entry in entries if entry['status'] in ('queued', 'running'))
+    return render_template('batch.html', batch_id=batch_id, entries=entries, pending=pending)
+
+def process_pdf_file(path, export_formats=('md', 'docx'), output_dir='summaries'):
+    """
+    Runs extraction -> summary -> export synchronously for one PDF on disk, using the
+    result cache, and copies the exports and image to output_dir (docs/ is only a cache
+    and gets pruned). Returns a manifest entry describing the outputs.
+    """
+    started = time.perf_counter()
+    filename = secure_filename(os.path.basename(path))
+    entry = {'path': path, 'sha256': None, 'status': 'done', 'cached': False, 'error': None}
+    try:
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        entry['sha256'] = hashlib.sha256(pdf_bytes).hexdigest()
+        cache_key = result_cache_key(pdf_bytes)
+        cached = result_cache_get(cache_key)
+        if cached:
+            result = cached['result']
+            entry['cached'] = True
+        else:
+            extracted_text = extract_pdf_text(pdf_bytes)
+            if not extracted_text.strip():
+                raise EmptyPDFError(f"No text could be extracted from {filename}.")
+            result = run_summary_pipeline(extracted_text, filename)
+            if is_cacheable_result(result):
+                result_cache_put(cache_key, extracted_text, result)
+                index_processed_paper(cache_key, extracted_text, filename, result)
+            index_summary(cache_key, filename, result)
+        summary = result.get('structured_summary_text') or ''
+        if summary.startswith("Error:"):
+            entry['status'] = 'failed'
+            entry['error'] = summary
+        # Named after the PDF and its content, so equal stems in different folders do not collide.
+        output_prefix = os.path.join(output_dir, f"{os.path.splitext(filename)[0]}_{entry['sha256'][:12]}")
+        entry['outputs'] = {}
+        for fmt in export_formats:
+            entry['outputs'][fmt] = None
+            if summary:
+                entry['outputs'][fmt] = f"{output_prefix}_summary.{fmt}"
+                shutil.copyfile(get_export(summary, fmt), entry['outputs'][fmt])
+        image_name = result.get('visualization_image_path')
+        image_data = get_media_store().get(image_name) if image_name else None
+        entry['outputs']['image'] = None
+        if image_data is not None:
+            entry['outputs']['image'] = f"{output_prefix}_visualization{os.path.splitext(image_name)[1]}"
+            with open(entry['outputs']['image'], 'wb') as f:
+                f.write(image_data)
+        entry['visualization_prompt'] = result.get('visualization_prompt')
+        entry['stage_errors'] = result.get('stage_errors') or {}
+    except Exception as e:
+        entry['status'] = 'failed'
+        entry['error'] = f"{type(e).__name__}: {e}"
+    entry['seconds'] = round(time.perf_counter() - started, 3)
+    entry['finished_at'] = datetime.now().isoformat()
+    return entry
+
+def _load_finished_manifest_entries(manifest_path):
+    """Maps path -> sha256 for every successfully processed file in an existing manifest."""
+    finished = {}
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError: # A line cut short by a crash
+                continue
+            if entry.get('status') == 'done':
+                finished[entry['path']] = entry['sha256']
+    return finished
+
+@app.cli.command('batch')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--workers', type=int, default=None, help='Papers processed in parallel (default: JOB_WORKERS).')
+@click.option('--manifest', 'manifest_path', type=click.Path(dir_okay=False), default=None,
+              help='JSON Lines manifest of outputs (default: DIRECTORY/manifest.jsonl).')
+@click.option('--recursive/--no-recursive', default=True, help='Include PDFs in subdirectories.')
+@click.option('--resume/--no-resume', default=True, help='Skip PDFs already processed successfully according to the manifest.')
+@click.option('--formats', default='md,docx', show_default=True,
+              help=f"Comma-separated export formats to write (available: {', '.join(EXPORT_FORMATS)}).")
+@click.option('--output-dir', type=click.Path(file_okay=False), default=None,
+              help='Directory for the exports and images (default: summaries/ next to the manifest).')
+def batch_command(directory, workers, manifest_path, recursive, resume, formats, output_dir):
+    """Summarizes every PDF in DIRECTORY with the same pipeline as the web app."""
+    manifest_path = manifest_path or os.path.join(directory, 'manifest.jsonl')
+    output_dir = output_dir or os.path.join(os.path.dirname(os.path.abspath(manifest_path)), 'summaries')
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if allowed_file(name))
+        if not recursive:
+            break
+
+    if resume:
+        finished = _load_finished_manifest_entries(manifest_path)
+        todo = []
+        for path in paths:
+            if path in finished:
+                with open(path, 'rb') as f:
+                    if hashlib.sha256(f.read()).hexdigest() == finished[path]:
+                        continue # Unchanged since it was processed
+            todo.append(path)
+        if len(todo) < len(paths):
+            click.echo(f"Resuming: {len(paths) - len(todo)} of {len(paths)} PDFs already done.")
+        paths = todo
+
+    if not paths:
+        click.echo("Nothing to do.")
+        return
+    export_formats = [fmt.strip() for fmt in formats.split(',') if fmt.strip()]
+    unknown_formats = [fmt for fmt in export_formats if fmt not in EXPORT_FORMATS]
+    if unknown_formats:
+        raise click.BadParameter(f"Unknown format(s): {', '.join(unknown_formats)}", param_hint='--formats')
+
+    workers = workers or app.config['JOB_WORKERS']
+    os.makedirs(output_dir, exist_ok=True)
+    click.echo(f"Processing {len(paths)} PDFs with {workers} workers; manifest: {manifest_path}; outputs: {output_dir}")
+    started = time.perf_counter()
+    failed = 0
+    manifest_lock = threading.Lock()
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch') as executor:
+        futures = {executor.submit(process_pdf_file, path, export_formats, output_dir): path for path in paths}
+        for count, future in enumerate(as_completed(futures), start=1):
+            entry = future.result()
+            with manifest_lock:
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+                os.fsync(manifest.fileno()) # Survives a crash, so --resume can skip this file
+            if entry['status'] != 'done':
+                failed += 1
+            elapsed = time.perf_counter() - started
+            click.echo(f"[{count}/{len(paths)}] {entry['status']:6} {entry['seconds']:7.2f}s "
+                       f"{'(cached) ' if entry['cached'] else ''}{entry['path']}"
+                       f"{' - ' + entry['error'] if entry['error'] else ''} "
+                       f"| {count / elapsed:.2f} papers/s")
+    click.echo(f"Finished {len(paths)} PDFs in {time.perf_counter() - started:.1f}s; {failed} failed.")
+# --- End Batch Ingestion ---
+
+@app.route('/download_doc/<upload_id>/<fmt>')
+def download_doc(upload_id, fmt):
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format; expected one of {sorted(EXPORT_FORMATS)}."}), 404
+    try:
+        summary_text = get_artifact_text(upload_id, 'summary.txt')
+        upload_info = get_artifact_json(upload_id, 'upload.json') or {}
+    except ValueError:
+        summary_text = None
+    if summary_text is None:
+        return jsonify({'error': 'No summary available for this upload.'}), 404
+
+    export_path = get_export(summary_text, fmt)
+    download_name = f"{os.path.splitext(upload_info.get('original_filename', 'paper'))[0]}_summary.{fmt}"
+    return send_from_directory(DOCS_DIR, os.path.basename(export_path), as_attachment=True,
+                               download_name=download_name, mimetype=EXPORT_FORMATS[fmt]['mimetype'])
+
+@app.route('/search/<key>/download/<fmt>')
+def download_indexed_summary(key, fmt):
+    """Downloads a search result's summary; works for batch-command papers and expired uploads too."""
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format; expected one of {sorted(EXPORT_FORMATS)}."}), 404
+    entry = get_indexed_summary(key)
+    if entry is None:
+        return jsonify({'error': 'No summary available for this search result.'}), 404
+
+    export_path = get_export(entry['summary_text'], fmt)
+    download_name = f"{os.path.splitext(entry['original_filename'])[0]}_summary.{fmt}"
+    return send_from_directory(DOCS_DIR, os.path.basename(export_path), as_attachment=True,
+                               download_name=download_name, mimetype=EXPORT_FORMATS[fmt]['mimetype'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,323 @@
+"""
+End-to-end benchmark for the upload -> summarize -> results pipeline.
+
+Generates synthetic PDFs, starts local stand-in HTTP servers that speak the OpenAI chat
+completions and Anthropic messages APIs (with configurable latency and 429 rate), points
+the app at them and drives it through the Flask test client from N concurrent clients.
+
+Reports extraction pages/sec, end-to-end p50/p95/p99 latency and throughput, and writes
+a JSON report tagged with the current git commit so runs can be compared across commits:
+
+    python benchmarks/bench_pipeline.py --pages 50 --clients 8 --requests 40 --json-out before.json
+    python benchmarks/bench_pipeline.py --pages 50 --clients 8 --requests 40 --compare before.json
+"""
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("model data result method analysis network protein signal sample error training "
+         "baseline accuracy dataset theory experiment energy cell measure significant "
+         "approach propose observe increase reduce compare evaluate distribution").split()
+
+
+# --- Synthetic PDFs ---
+def make_synthetic_pdf(pages, words_per_page, seed=0, title="Synthetic Paper"):
+    """Returns the bytes of a PDF with running headers/footers, section headings and random prose."""
+    import fitz # PyMuPDF
+    rng = random.Random(seed)
+    doc = fitz.open()
+    sections = ["Abstract", "Introduction", "Methods", "Results", "Discussion", "References"]
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 40), f"{title} - Proceedings of the Benchmark Conference", fontsize=8)
+        body = []
+        if page_num * len(sections) // pages != (page_num - 1) * len(sections) // pages or page_num == 0:
+            body.append(sections[page_num * len(sections) // pages].upper())
+        words = [rng.choice(WORDS) for _ in range(words_per_page)]
+        body.extend(" ".join(words[i:i + 12]) + "." for i in range(0, len(words), 12))
+        page.insert_textbox(fitz.Rect(72, 60, page.rect.width - 72, page.rect.height - 60), "\n".join(body), fontsize=9)
+        page.insert_text((page.rect.width / 2, page.rect.height - 30), str(page_num + 1), fontsize=8)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+# --- Stand-in LLM servers ---
+class StubLLMServer(ThreadingHTTPServer):
+    """Mimics /v1/chat/completions (OpenAI) and /v1/messages (Anthropic) with fake latency and 429s."""
+    daemon_threads = True
+
+    def __init__(self, latency, jitter, rate_limit_ratio, seed=0):
+        super().__init__(('127.0.0.1', 0), StubLLMHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_ratio = rate_limit_ratio
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'openai': 0, 'anthropic': 0, 'rate_limited': 0}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def roll(self):
+        """Returns (should_rate_limit, delay) for one request."""
+        with self.lock:
+            return self.rng.random() < self.rate_limit_ratio, max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like the real APIs
+
+    SUMMARY = ("Abstract: A synthetic abstract generated by the benchmark stub.\n"
+               "Introduction: The paper introduces a benchmark scenario.\n"
+               "Results: Latency and throughput are measured end to end.\n"
+               "Discussion: Numbers are only comparable between runs with the same settings.")
+    PROMPT = "A clean scientific diagram of a benchmark pipeline with charts of latency and throughput."
+
+    def log_message(self, format, *args): # Keep benchmark output readable
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt_chars = sum(len(str(message.get('content', ''))) for message in request.get('messages', []))
+        rate_limited, delay = self.server.roll()
+        if rate_limited:
+            with self.server.lock:
+                self.server.counts['rate_limited'] += 1
+            self._send_json(429, {'error': {'type': 'rate_limit_error', 'message': 'Stub rate limit.'}}, {'retry-after': '0.1'})
+            return
+        time.sleep(delay)
+
+        if self.path.endswith('/chat/completions'):
+            with self.server.lock:
+                self.server.counts['openai'] += 1
+            usage = {'prompt_tokens': prompt_chars // 4, 'completion_tokens': len(self.SUMMARY) // 4,
+                     'total_tokens': prompt_chars // 4 + len(self.SUMMARY) // 4}
+            if request.get('stream'):
+                self._stream_openai(request.get('model'), usage)
+                return
+            self._send_json(200, {
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': request.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.SUMMARY}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+        elif self.path.endswith('/messages'):
+            with self.server.lock:
+                self.server.counts['anthropic'] += 1
+            self._send_json(200, {
+                'id': 'msg_bench', 'type': 'message', 'role': 'assistant', 'model': request.get('model'),
+                'content': [{'type': 'text', 'text': self.PROMPT}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+                'usage': {'input_tokens': prompt_chars // 4, 'output_tokens': len(self.PROMPT) // 4},
+            })
+        else:
+            self._send_json(404, {'error': {'type': 'not_found_error', 'message': self.path}})
+
+    def _stream_openai(self, model, usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close') # No Content-Length; the end of the body ends the stream
+        self.end_headers()
+        chunk = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model}
+        for piece in self.SUMMARY.split(' '):
+            event = dict(chunk, choices=[{'index': 0, 'delta': {'content': piece + ' '}, 'finish_reason': None}])
+            self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+        self.wfile.write(f"data: {json.dumps(dict(chunk, choices=[], usage=usage))}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+# --- Benchmark runs ---
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def bench_extraction(app_module, pdfs, repeat):
+    import fitz # PyMuPDF
+    # Count pages from the documents: condensation drops pages that end up empty.
+    page_counts = []
+    for pdf_bytes in pdfs:
+        with fitz.open(stream=pdf_bytes, filetype='pdf') as doc:
+            page_counts.append(len(doc))
+    total_pages, started = 0, time.perf_counter()
+    for _ in range(repeat):
+        for pdf_bytes, page_count in zip(pdfs, page_counts):
+            app_module.extract_pdf_text(pdf_bytes)
+            total_pages += page_count
+    elapsed = time.perf_counter() - started
+    return {'pages': total_pages, 'seconds': round(elapsed, 4), 'pages_per_second': round(total_pages / elapsed, 1)}
+
+
+def _run_one_upload(app_module, pdf_bytes, filename, timeout):
+    """
+    Uploads one PDF through the web routes and waits for its job. Returns (seconds, status);
+    a finished job whose summary is a provider error or that has failed stages counts as 'error'.
+    """
+    client = app_module.app.test_client()
+    started = time.perf_counter()
+    client.post('/', data={'pdf_file': (io.BytesIO(pdf_bytes), filename)},
+                content_type='multipart/form-data', follow_redirects=False)
+    client.get('/process_and_summarize')
+    with client.session_transaction() as session:
+        job_id = session.get('job_id')
+    if not job_id:
+        return time.perf_counter() - started, 'rejected'
+    while time.perf_counter() - started < timeout:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        status = job['status']
+        if status in ('done', 'failed'):
+            client.get('/results')
+            result = job.get('result') or {}
+            summary = result.get('structured_summary_text') or ''
+            if status == 'done' and (not summary or summary.startswith('Error:') or result.get('stage_errors')):
+                status = 'error'
+            return time.perf_counter() - started, status
+        time.sleep(0.01)
+    return time.perf_counter() - started, 'timeout'
+
+
+def bench_end_to_end(app_module, pdfs, clients, requests, timeout):
+    latencies, statuses = [], {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [executor.submit(_run_one_upload, app_module, pdfs[i % len(pdfs)], f"bench_{i}.pdf", timeout)
+                   for i in range(requests)]
+        for future in futures:
+            seconds, status = future.result()
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 'done':
+                latencies.append(seconds)
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'clients': clients,
+        'statuses': statuses,
+        'seconds': round(elapsed, 4),
+        'throughput_per_second': round(len(latencies) / elapsed, 3),
+        'latency_p50': round(percentile(latencies, 50), 4) if latencies else None,
+        'latency_p95': round(percentile(latencies, 95), 4) if latencies else None,
+        'latency_p99': round(percentile(latencies, 99), 4) if latencies else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(report, baseline):
+    print(f"\nComparison with {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    rows = [('extraction pages/s', ('extraction', 'pages_per_second'), True),
+            ('throughput req/s', ('end_to_end', 'throughput_per_second'), True),
+            ('latency p50 s', ('end_to_end', 'latency_p50'), False),
+            ('latency p95 s', ('end_to_end', 'latency_p95'), False),
+            ('latency p99 s', ('end_to_end', 'latency_p99'), False)]
+    for label, (group, key), higher_is_better in rows:
+        old, new = baseline.get(group, {}).get(key), report[group].get(key)
+        if not old or new is None:
+            print(f"  {label:20} {old} -> {new}")
+            continue
+        change = (new - old) / old * 100
+        better = change > 0 if higher_is_better else change < 0
+        print(f"  {label:20} {old:10.4f} -> {new:10.4f}  ({change:+.1f}%, {'better' if better else 'worse'})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', type=int, default=20, help='Pages per synthetic PDF.')
+    parser.add_argument('--words-per-page', type=int, default=400, help='Text density of the synthetic PDFs.')
+    parser.add_argument('--pdfs', type=int, default=4, help='Distinct synthetic PDFs to generate.')
+    parser.add_argument('--clients', type=int, default=4, help='Concurrent clients for the end-to-end run.')
+    parser.add_argument('--requests', type=int, default=16, help='Total uploads in the end-to-end run.')
+    parser.add_argument('--extraction-repeat', type=int, default=3, help='Passes over the PDFs for the extraction run.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean stub LLM latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.05, help='Standard deviation of the stub latency.')
+    parser.add_argument('--rate-limit-ratio', type=float, default=0.0, help='Fraction of stub requests answered with 429.')
+    parser.add_argument('--timeout', type=float, default=300, help='Per-upload timeout in seconds.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json-out', help='Write the JSON report to this path.')
+    parser.add_argument('--compare', help='Print a comparison with an earlier JSON report.')
+    args = parser.parse_args(argv)
+
+    server = StubLLMServer(args.latency, args.jitter, args.rate_limit_ratio, seed=args.seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The app creates docs/, cache/ and artifacts/ relative to the working directory.
+    workdir = tempfile.mkdtemp(prefix='pipeline-bench-')
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as app_module
+
+    app_module.app.config.update(
+        OPENAI_API_KEY='bench', ANTHROPIC_API_KEY='bench', GEMINI_API_KEY=None,
+        OPENAI_BASE_URL=f"{server.base_url}/v1", ANTHROPIC_BASE_URL=server.base_url, LLM_BACKEND='live',
+        OPENAI_REQUESTS_PER_MINUTE=1_000_000, OPENAI_TOKENS_PER_MINUTE=1_000_000_000,
+        ANTHROPIC_REQUESTS_PER_MINUTE=1_000_000, ANTHROPIC_TOKENS_PER_MINUTE=1_000_000_000,
+        PROVIDER_BACKOFF_BASE_SECONDS=0.05,
+        # Keep generated visualization images out of the repository's static/ folder.
+        MEDIA_STORE_PATH=os.path.join(workdir, 'media'),
+    )
+
+    print(f"Generating {args.pdfs} synthetic PDFs of {args.pages} pages...")
+    # Each upload gets a distinct PDF so the result cache does not short-circuit the pipeline.
+    pdfs = [make_synthetic_pdf(args.pages, args.words_per_page, seed=args.seed + i, title=f"Paper {i}")
+            for i in range(max(args.pdfs, args.requests))]
+
+    extraction = bench_extraction(app_module, pdfs[:args.pdfs], args.extraction_repeat)
+    print(f"Extraction: {extraction['pages_per_second']} pages/s ({extraction['pages']} pages in {extraction['seconds']}s)")
+
+    end_to_end = bench_end_to_end(app_module, pdfs, args.clients, args.requests, args.timeout)
+    print(f"End to end: {end_to_end['throughput_per_second']} papers/s with {args.clients} clients; "
+          f"p50 {end_to_end['latency_p50']}s p95 {end_to_end['latency_p95']}s p99 {end_to_end['latency_p99']}s; "
+          f"statuses {end_to_end['statuses']}")
+    print(f"Stub server requests: {server.counts}")
+    server.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(),
+        'settings': vars(args),
+        'extraction': extraction,
+        'end_to_end': end_to_end,
+        'stub_requests': server.counts,
+    }
+    if args.json_out:
+        with open(os.path.join(REPO_ROOT, args.json_out) if not os.path.isabs(args.json_out) else args.json_out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(os.path.join(REPO_ROOT, args.compare) if not os.path.isabs(args.compare) else args.compare) as f:
+            print_comparison(report, json.load(f))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Page-level PDF extraction, run both in the app process and in its extraction worker
+processes. Workers start from a clean interpreter (forkserver/spawn) and unpickle these
+functions by module, so this module imports only PyMuPDF: importing app.py there would
+load Flask and every provider SDK and rerun the app's startup code in each worker.
+"""
+import fitz # PyMuPDF
+
+
+def open_pdf(source):
+    """Opens a PDF from in-memory bytes or from a file path, without copying it to disk."""
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+def page_layout(page):
+    """Returns one page's lines as (text, font size, bold, top, bottom) plus the page height."""
+    layout = page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT) # No image data
+    lines = []
+    for block in layout['blocks']:
+        for line in block.get('lines', []):
+            spans = [span for span in line['spans'] if span['text'].strip()]
+            if not spans:
+                continue
+            text = "".join(span['text'] for span in spans).strip()
+            size = max(span['size'] for span in spans)
+            bold = all(span['flags'] & fitz.TEXT_FONT_BOLD for span in spans)
+            lines.append((text, round(size, 1), bold, line['bbox'][1], line['bbox'][3]))
+    return {'height': layout['height'], 'lines': lines}
+
+def extract_page(page, layout):
+    return page_layout(page) if layout else page.get_text("text")
+
+def extract_page_range(source, start, stop, layout=False):
+    """
+    Returns the text of pages [start, stop), or their layouts (see page_layout) if layout
+    is true. Runs in extraction worker processes.
+    """
+    doc = open_pdf(source)
+    try:
+        return [extract_page(doc.load_page(page_num), layout) for page_num in range(start, stop)]
+    finally:
+        doc.close()
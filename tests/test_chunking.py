@@ -0,0 +1,57 @@
+"""Tests for splitting extracted text into summary chunks."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def char_estimate(monkeypatch):
+    """Forces the ~4 characters per token estimate, whether or not tiktoken is installed."""
+    monkeypatch.setattr(app, 'tiktoken', None)
+
+
+class _OneTokenPerCharacter:
+    """Stands in for tiktoken with an encoding as dense as numeric or non-Latin text."""
+
+    @staticmethod
+    def encoding_for_model(model):
+        return _OneTokenPerCharacter()
+
+    def encode(self, text, disallowed_special=()):
+        return list(text)
+
+
+def test_chunk_text_packs_whole_pages(char_estimate):
+    pages = ["a" * 40, "b" * 40, "c" * 40] # 10 estimated tokens each
+    chunks = app.chunk_text_for_summary(app.PAGE_SEPARATOR.join(pages), max_tokens=25)
+
+    assert chunks == ["a" * 40 + "\n" + "b" * 40, "c" * 40]
+
+
+def test_chunk_text_splits_oversized_page_on_paragraphs(char_estimate):
+    page = "\n\n".join(["x" * 80, "y" * 80, "z" * 80]) # 20 estimated tokens per paragraph
+    chunks = app.chunk_text_for_summary(page, max_tokens=25)
+
+    assert chunks == ["x" * 80, "y" * 80, "z" * 80]
+
+
+def test_chunk_text_respects_limit_and_keeps_all_text(char_estimate):
+    text = app.PAGE_SEPARATOR.join("word " * n for n in (5, 300, 40, 2))
+    chunks = app.chunk_text_for_summary(text, max_tokens=50)
+
+    assert all(app.estimate_tokens(chunk) <= 50 for chunk in chunks)
+    assert "".join(chunks).count("word") == 347
+
+
+def test_chunk_text_skips_blank_pages(char_estimate):
+    assert app.chunk_text_for_summary(app.PAGE_SEPARATOR.join(["", "  ", "text"]), max_tokens=10) == ["text"]
+
+
+def test_split_oversized_unit_uses_real_token_counts(monkeypatch):
+    monkeypatch.setattr(app, 'tiktoken', _OneTokenPerCharacter)
+    unit = "7" * 95 # 95 tokens, but only 24 by the 4-characters estimate
+
+    pieces = app._split_oversized_unit(unit, max_tokens=10)
+
+    assert "".join(pieces) == unit
+    assert [len(piece) for piece in pieces] == [10] * 9 + [5]
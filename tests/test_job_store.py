@@ -0,0 +1,60 @@
+"""Tests for the file job store shared by several hosts."""
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def job_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'JOB_PARTIAL_FLUSH_SECONDS', 0.01)
+    monkeypatch.setitem(app.app.config, 'JOB_POLL_SECONDS', 0.01)
+    return str(tmp_path / 'jobs')
+
+
+def make_job(job_id, status='queued'):
+    record = app._new_job_record(job_id, 'ab' * 16, 'paper.pdf')
+    record['status'] = status
+    return record
+
+
+def test_file_job_store_is_visible_to_other_instances(job_dir):
+    host_a, host_b = app.FileJobStore(job_dir), app.FileJobStore(job_dir)
+    host_a.create(make_job('a1'))
+    host_a.update('a1', status='running')
+
+    assert host_b.get('a1')['status'] == 'running'
+    assert host_b.count_by_status() == {'running': 1}
+
+
+def test_file_job_store_flushes_buffered_tokens_in_order(job_dir):
+    store = app.FileJobStore(job_dir)
+    store.create(make_job('a1'))
+    for i in range(50):
+        store.append_summary_partial('a1', f"{i} ")
+    store.update('a1', status='done')
+
+    job = app.FileJobStore(job_dir).wait_for('a1', lambda job: job['status'] == 'done', timeout=1)
+    assert job['summary_partial'] == "".join(f"{i} " for i in range(50))
+
+
+def test_file_job_store_rejects_invalid_job_ids(job_dir):
+    store = app.FileJobStore(job_dir)
+
+    assert store.get('../../etc/passwd') is None
+    with pytest.raises(KeyError):
+        store.update('not-a-job', status='done')
+
+
+def test_file_job_store_cleanup_keeps_recent_and_unfinished_jobs(job_dir, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'JOB_MAX_FINISHED', 1)
+    store = app.FileJobStore(job_dir)
+    for job_id, status in (('a1', 'done'), ('a2', 'done'), ('a3', 'running')):
+        store.create(make_job(job_id, status))
+    old = time.time() - 100
+    os.utime(os.path.join(job_dir, 'a1.json'), (old, old))
+
+    assert store.cleanup(ttl_seconds=3600) == 1
+    assert store.get('a1') is None and store.get('a2') and store.get('a3')
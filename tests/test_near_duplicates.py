@@ -0,0 +1,33 @@
+"""Tests for the MinHash signatures behind near-duplicate detection."""
+import app
+
+
+def _estimated_jaccard(a, b):
+    return sum(x == y for x, y in zip(a, b)) / app.MINHASH_SIZE
+
+
+def test_minhash_signature_is_deterministic_and_sized():
+    text = " ".join(f"word{i}" for i in range(200))
+    signature = app.minhash_signature(text)
+
+    assert len(signature) == app.MINHASH_SIZE
+    assert signature == app.minhash_signature(text.upper()) # Case and punctuation are ignored
+
+
+def test_minhash_signature_returns_none_without_words():
+    assert app.minhash_signature("") is None
+    assert app.minhash_signature("... --- !!!") is None
+
+
+def test_minhash_signature_estimates_similarity():
+    words = [f"word{i}" for i in range(2000)]
+    near = words[:1950] + [f"other{i}" for i in range(50)]
+    unrelated = [f"other{i}" for i in range(2000)]
+    signature = app.minhash_signature(" ".join(words))
+
+    assert _estimated_jaccard(signature, app.minhash_signature(" ".join(near))) > 0.8
+    assert _estimated_jaccard(signature, app.minhash_signature(" ".join(unrelated))) < 0.1
+
+
+def test_minhash_signature_handles_texts_shorter_than_a_shingle():
+    assert len(app.minhash_signature("two words")) == app.MINHASH_SIZE
@@ -0,0 +1,41 @@
+"""Tests for the full-text search index over generated summaries."""
+import pytest
+
+import app
+
+
+@pytest.fixture
+def search_index(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'SEARCH_INDEX_PATH', str(tmp_path / 'search.sqlite3'))
+
+
+def test_fts_match_expression_quotes_words_and_prefixes_last():
+    assert app._fts_match_expression("graph neural netw") == '"graph" "neural" "netw"*'
+
+
+def test_fts_match_expression_neutralizes_fts_operators():
+    assert app._fts_match_expression('title:foo OR "bar" NEAR(baz)*') == '"title" "foo" "OR" "bar" "NEAR" "baz"*'
+
+
+def test_fts_match_expression_returns_none_without_words():
+    assert app._fts_match_expression("") is None
+    assert app._fts_match_expression(" -*()\" ") is None
+
+
+def test_search_finds_indexed_summary_and_keeps_its_text(search_index):
+    summary = "Abstract: We study attention in transformers.\nResults: BLEU improves by 2 points."
+    app.index_summary("key1", "attention.pdf", {'structured_summary_text': summary, 'visualization_prompt': "heatmap"})
+    app.index_summary("key2", "other.pdf", {'structured_summary_text': "Abstract: Protein folding."})
+
+    total, results = app.search_summaries("transf")
+
+    assert total == 1
+    assert results[0]['key'] == "key1" and results[0]['upload_id'] is None
+    assert app.get_indexed_summary("key1") == {'original_filename': "attention.pdf", 'summary_text': summary}
+
+
+def test_index_summary_skips_error_results(search_index):
+    app.index_summary("key1", "failed.pdf", {'structured_summary_text': "Error: provider unavailable"})
+
+    assert app.search_summaries("provider") == (0, [])
+    assert app.get_indexed_summary("key1") is None
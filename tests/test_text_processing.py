@@ -0,0 +1,89 @@
+"""Tests for condensing extracted PDF text before summarization."""
+import app
+
+PAGE_HEIGHT = 800
+BODY_SIZE = 10.0
+
+
+def make_page(*lines):
+    """Builds a layout like pdf_extraction.page_layout returns; lines are (text, top) or (text, top, size, bold)."""
+    page_lines = []
+    for line in lines:
+        text, top, size, bold = line if len(line) == 4 else line + (BODY_SIZE, False)
+        page_lines.append((text, size, bold, top, top + size))
+    return {'height': PAGE_HEIGHT, 'lines': page_lines}
+
+
+def body(n, top=200):
+    return (f"Body sentence number {n} describing the method and results in some detail.", top)
+
+
+def heading(text, top=150):
+    return (text, top, BODY_SIZE, True)
+
+
+# --- condense_pages ---
+
+def test_condense_pages_drops_repeated_headers_and_page_numbers():
+    pages = [make_page((f"Journal of Synthetic Tests, Vol. 3, p. {n}", 10), body(n), (str(n), 780))
+             for n in range(1, 5)]
+
+    page_texts, stats = app.condense_pages(pages)
+
+    assert page_texts == [body(n)[0] for n in range(1, 5)]
+    # Footer page numbers repeat modulo digits, so they are removed as running footers.
+    assert stats['header_footer_lines'] == 8
+
+
+def test_condense_pages_keeps_header_like_line_that_does_not_repeat():
+    pages = [make_page(("A one-off note in the top margin", 10), body(1)), make_page(body(2)), make_page(body(3))]
+
+    page_texts, stats = app.condense_pages(pages)
+
+    assert page_texts[0].startswith("A one-off note in the top margin")
+    assert stats['header_footer_lines'] == 0
+
+
+def test_condense_pages_references_in_table_of_contents_does_not_cut_text():
+    toc = make_page(heading("Contents", 100), ("1 Introduction", 150), ("2 Method", 170), ("3 References", 190))
+    pages = [toc] + [make_page(heading(f"{n} Section {n}", 100), body(n), body(n + 10, 250)) for n in range(1, 4)]
+    pages.append(make_page(heading("References", 100), ("[1] A. Author. Some cited work. 2020.", 150)))
+
+    page_texts, stats = app.condense_pages(pages)
+
+    assert "3 References" in page_texts[0]
+    assert all(body(n)[0] in "\n".join(page_texts) for n in range(1, 4))
+    assert "Some cited work" not in "\n".join(page_texts)
+    assert stats['removed_sections'] == ["References"]
+
+
+def test_condense_pages_skips_acknowledgements_until_next_heading():
+    pages = [
+        make_page(heading("1 Introduction", 100), body(1), body(2, 250)),
+        make_page(heading("Acknowledgements", 100), ("We thank the funding agency for its generous support.", 150),
+                  heading("2 Discussion", 300), body(3, 350)),
+        make_page(body(4), body(5, 250)),
+    ]
+
+    page_texts, stats = app.condense_pages(pages)
+    text = "\n".join(page_texts)
+
+    assert "funding agency" not in text
+    assert "Acknowledgements" not in text
+    assert "2 Discussion" in text and body(3)[0] in text and body(4)[0] in text
+    assert stats['removed_sections'] == ["Acknowledgements"]
+
+
+def test_condense_pages_handles_empty_document():
+    assert app.condense_pages([]) == ([], {'header_footer_lines': 0, 'page_number_lines': 0,
+                                           'headings': 0, 'removed_sections': []})
+
+
+def test_result_cache_key_covers_condensation_settings(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'CONDENSE_TEXT', True)
+    condensed = app.result_cache_key(b"%PDF-1.7")
+    monkeypatch.setitem(app.app.config, 'CONDENSE_TEXT', False)
+    raw = app.result_cache_key(b"%PDF-1.7")
+    monkeypatch.setitem(app.app.config, 'SUMMARY_CHUNK_TOKENS', app.app.config['SUMMARY_CHUNK_TOKENS'] + 1)
+
+    assert len({condensed, raw, app.result_cache_key(b"%PDF-1.7")}) == 3